@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import struct
+import subprocess
+import zlib
+
+import mock_api_server
+import step3_gpt_api_frame_ratings as step3
+
+#%% Change parameters
+
+# Video frame folders to rate (step1 output); '' creates synthetic ones in benchmark_folder
+frames_folder = r""
+benchmark_folder = r""  # CHANGE
+
+synthetic_videos = 4
+synthetic_frames_per_video = 40
+synthetic_frame_size = (320, 180)
+
+# max_in_flight values to compare
+concurrency_levels = [1, 4, 8, 16]
+
+# Seconds before the checkpoint-recovery run is killed
+crash_after = 5.0
+
+# Stand-in API behaviour (see mock_api_server.py)
+mock_settings = {
+    "latency_distribution": 'lognormal',
+    "latency_mean": 0.5,
+    "latency_spread": 0.4,
+    "rate_limit_probability": 0.02,
+    "rate_limit_wait": 0.5,
+    "truncation_probability": 0.02,
+    "incomplete_probability": 0.02,
+    "malformed_probability": 0.01,
+    "requests_per_minute": None,
+    "seed": 1
+}
+
+#%% Synthetic frames
+
+def write_png(path, width, height, rng):
+    """ Minimal RGB PNG of random blocks (no imaging library needed) """
+    block = 16
+    colors = [[bytes(rng.randrange(256) for _ in range(3)) for _ in range(width // block + 1)]
+              for _ in range(height // block + 1)]
+    raw = b''.join(b'\x00' + b''.join(colors[y // block][x // block] for x in range(width)) for y in range(height))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw, 6)))
+        f.write(chunk(b'IEND', b''))
+
+def make_synthetic_frames(folder, videos, frames_per_video, size):
+    """ Video folders of random PNG frames plus a short transcript, laid out like step1/step2 output """
+    rng = random.Random(0)
+    for video_index in range(videos):
+        video_folder = os.path.join(folder, f'video_{video_index + 1:03d}')
+        os.makedirs(video_folder, exist_ok=True)
+        for frame_index in range(frames_per_video):
+            frame_path = os.path.join(video_folder, f'frame_{frame_index + 1:04d}.png')
+            if not os.path.exists(frame_path):
+                write_png(frame_path, size[0], size[1], rng)
+        with open(os.path.join(video_folder, f'video_{video_index + 1:03d}.txt'), 'w', encoding='utf-8') as f:
+            f.write("Synthetic transcript used for benchmarking.")
+
+#%% Measurements
+
+def configure_step3(url, max_in_flight):
+    """ Point step3 at the stand-in API and switch off everything that would make runs share state """
+    settings = {
+        "api_url": url,
+        "api_key": 'mock',
+        "max_in_flight": max_in_flight,
+        "metrics_file": '',
+        "response_cache_folder": '',
+        "image_cache_folder": '',
+        "progress_interval": 3600
+    }
+    for name, value in settings.items():
+        setattr(step3, name, value)
+    return settings
+
+def minimum_requests(frames_folder):
+    """ Requests a run needs without any retry: one per pack of frames that are not near-duplicates """
+    requests = 0
+    for subfolder in sorted(os.listdir(frames_folder)):
+        subfolder_path = os.path.join(frames_folder, subfolder)
+        if os.path.isdir(subfolder_path):
+            video = step3.collect_video_inputs(subfolder, subfolder_path, set())
+            requested = [frame for frame in video["frames"] if frame["frame_filename"] not in video["duplicate_of"]]
+            requests += math.ceil(len(requested) / step3.frames_per_request)
+    return requests
+
+def read_journal(output_folder, round_number=1):
+    """ (journal lines, distinct frames) of a round's journal; lines cut off by a crash are skipped """
+    journal_path = os.path.join(output_folder, f'output_{round_number}_{step3.extra_round}.jsonl')
+    lines = 0
+    frames = set()
+    try:
+        with open(journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                lines += 1
+                frames.add((record["subfolder"], record["frame_filename"]))
+    except FileNotFoundError:
+        pass
+    return lines, len(frames)
+
+def run_throughput(server, frames_folder, output_folder, max_in_flight, needed_requests):
+    """ Rate one round from scratch and measure frames per second and retry overhead """
+    shutil.rmtree(output_folder, ignore_errors=True)
+    configure_step3(server.url, max_in_flight)
+    server.reset_stats()
+    start_time = time.time()
+    step3.process_media_files(frames_folder, 1, output_folder)
+    seconds = time.time() - start_time
+    lines, frames = read_journal(output_folder)
+    stats = dict(server.stats)
+    return {
+        "max_in_flight": max_in_flight,
+        "seconds": round(seconds, 2),
+        "frames": frames,
+        "frames_per_second": round(frames / seconds, 2),
+        "requests": stats["requests"],
+        "retry_overhead": round(stats["requests"] / needed_requests - 1, 3) if needed_requests else None,
+        "server": stats
+    }
+
+def run_crash_recovery(server, frames_folder, output_folder, max_in_flight):
+    """
+    Kill a rating run after crash_after seconds, then resume it and check that every frame ends up in
+    the journal exactly once and that the resumed run only requests the frames that were missing
+    """
+    shutil.rmtree(output_folder, ignore_errors=True)
+    settings = configure_step3(server.url, max_in_flight)
+    code = (
+        "import sys, json\n"
+        f"sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r})\n"
+        "import step3_gpt_api_frame_ratings as step3\n"
+        "for name, value in json.loads(sys.argv[1]).items(): setattr(step3, name, value)\n"
+        "step3.process_media_files(sys.argv[2], 1, sys.argv[3])\n"
+    )
+    process = subprocess.Popen([sys.executable, '-c', code, json.dumps(settings), frames_folder, output_folder],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        process.wait(timeout=crash_after)
+        print("  ⚠️ The run finished before it could be killed; raise the frame count or lower crash_after")
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    lines_before, frames_before = read_journal(output_folder)
+
+    server.reset_stats()
+    start_time = time.time()
+    step3.process_media_files(frames_folder, 1, output_folder)
+    seconds = time.time() - start_time
+    lines_after, frames_after = read_journal(output_folder)
+    return {
+        "frames_before_crash": frames_before,
+        "resume_seconds": round(seconds, 2),
+        "resume_requests": server.stats["requests"],
+        "frames_after_resume": frames_after,
+        "duplicate_journal_lines": lines_after - frames_after
+    }
+
+#%% Run benchmark
+
+if __name__ == '__main__':
+    for name, value in mock_settings.items():
+        setattr(mock_api_server, name, value)
+    server = mock_api_server.start_server(port=0)
+    print(f"Mock API on {server.url}")
+
+    os.makedirs(benchmark_folder, exist_ok=True)
+    if not frames_folder:
+        frames_folder = os.path.join(benchmark_folder, 'frames')
+        make_synthetic_frames(frames_folder, synthetic_videos, synthetic_frames_per_video, synthetic_frame_size)
+    needed_requests = minimum_requests(frames_folder)
+
+    results = {"mock_settings": mock_settings, "frames_per_request": step3.frames_per_request,
+               "minimum_requests": needed_requests, "throughput": []}
+    for level in concurrency_levels:
+        print(f"\n=== Throughput with max_in_flight = {level} ===")
+        result = run_throughput(server, frames_folder, os.path.join(benchmark_folder, f'run_{level}'), level, needed_requests)
+        results["throughput"].append(result)
+
+    print(f"\n=== Checkpoint recovery (killed after {crash_after} sec.) ===")
+    results["recovery"] = run_crash_recovery(server, frames_folder, os.path.join(benchmark_folder, 'run_recovery'),
+                                             max(concurrency_levels))
+
+    print("\n=== Benchmark results ===")
+    print(f"{'max_in_flight':>13} {'frames':>7} {'seconds':>8} {'frames/s':>9} {'requests':>9} {'retry overhead':>15}")
+    for result in results["throughput"]:
+        print(f"{result['max_in_flight']:>13} {result['frames']:>7} {result['seconds']:>8} "
+              f"{result['frames_per_second']:>9} {result['requests']:>9} {result['retry_overhead']:>15.1%}")
+    recovery = results["recovery"]
+    print(f"\nRecovery: {recovery['frames_before_crash']} frames journaled before the crash, "
+          f"resumed in {recovery['resume_seconds']} sec. with {recovery['resume_requests']} requests, "
+          f"{recovery['frames_after_resume']} frames in the journal, {recovery['duplicate_journal_lines']} duplicate lines")
+
+    results_path = os.path.join(benchmark_folder, 'benchmark_results.json')
+    with open(results_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=4)
+    print(f"\n✓ Results saved to {results_path}")
+    server.shutdown()
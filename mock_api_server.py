@@ -0,0 +1,212 @@
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+#%% Change parameters
+
+# Address of the stand-in server (set api_url in step3 to http://host:port/v1/chat/completions)
+host = '127.0.0.1'
+port = 8000
+
+# Response time: 'fixed' (latency_mean), 'uniform' (latency_mean ± latency_spread) or 'lognormal' (median latency_mean, sigma latency_spread)
+latency_distribution = 'lognormal'
+latency_mean = 2.0  # Seconds
+latency_spread = 0.5
+
+# Share of requests answered with a fault
+rate_limit_probability = 0.02  # 429 with "Please try again in Xs."
+rate_limit_wait = 1.5  # The X in "try again in Xs"
+truncation_probability = 0.02  # Answer cut off with finish_reason "length"
+incomplete_probability = 0.02  # Answer with part of the features left out
+malformed_probability = 0.01  # HTTP 200 with a body that is not valid JSON
+
+# Requests per minute above which every request gets a 429 (None = no limit)
+requests_per_minute = None
+
+seed = None  # Fix the random faults and ratings
+
+#%% Synthetic answers
+
+# Header before each frame of a packed request, as sent by step3
+PACK_HEADER_PATTERN = re.compile(r'^###\s*(Frame \d+)\s*$')
+
+def request_features(content):
+    """ Feature names asked for in the prompt: the lines of the first text part that end in ':?' """
+    first_text = next((part["text"] for part in content if part.get("type") == "text"), "")
+    return [line.strip()[:-2].strip() for line in first_text.splitlines() if line.strip().endswith(':?')]
+
+def synthetic_content(body, rng, incomplete=False):
+    """ Answer in the format the request asks for ("Feature: Number" lines, JSON array/object, packed blocks) """
+    content = body["messages"][0]["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    features = request_features(content)
+    if incomplete:
+        features = features[:rng.randint(0, max(len(features) - 1, 0))]
+    frame_labels = [match.group(1) for part in content if part.get("type") == "text"
+                    for match in [PACK_HEADER_PATTERN.match(part["text"].strip())] if match]
+    instructions = ' '.join(part["text"] for part in content[1:] if part.get("type") == "text")
+
+    def ratings():
+        return [rng.randint(0, 100) for _ in features]
+
+    response_format = (body.get("response_format") or {}).get("type")
+    if response_format in ('json_schema', 'json_object') or 'JSON' in instructions:
+        if frame_labels:
+            return json.dumps({label: ratings() for label in frame_labels})
+        if response_format == 'json_schema' or '"ratings"' in instructions:
+            return json.dumps({"ratings": ratings()})
+        return json.dumps(ratings())
+
+    def lines():
+        return '\n'.join(f"{feature}: {rating}" for feature, rating in zip(features, ratings()))
+    if frame_labels:
+        return '\n\n'.join(f"### {label}\n{lines()}" for label in frame_labels)
+    return lines()
+
+def pick_fault(draw):
+    """ Fault for a uniform draw in [0, 1): 'rate_limited', 'truncated', 'incomplete', 'malformed' or None """
+    for fault, probability in (('rate_limited', rate_limit_probability), ('truncated', truncation_probability),
+                               ('incomplete', incomplete_probability), ('malformed', malformed_probability)):
+        if draw < probability:
+            return fault
+        draw -= probability
+    return None
+
+def sample_latency(rng):
+    if latency_distribution == 'fixed':
+        return latency_mean
+    if latency_distribution == 'uniform':
+        return max(0.0, rng.uniform(latency_mean - latency_spread, latency_mean + latency_spread))
+    return rng.lognormvariate(0.0, latency_spread) * latency_mean
+
+#%% Server
+
+class MockServer(ThreadingHTTPServer):
+    """ Threading HTTP server with the shared random generator and request counters of the stand-in API """
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, MockHandler)
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "ok": 0, "rate_limited": 0, "truncated": 0, "incomplete": 0, "malformed": 0,
+                      "max_in_flight": 0}
+        self.in_flight = 0
+        self.request_times = []
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/v1/chat/completions"
+
+    def handle_error(self, request, client_address):
+        # Clients that disconnect mid-answer (e.g. a killed benchmark run) are expected
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    def reset_stats(self):
+        with self.lock:
+            for key in self.stats:
+                self.stats[key] = 0
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real API
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, headers=None):
+        body = data if isinstance(data, bytes) else json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        raw_body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.path.endswith('/chat/completions'):
+            self.send_json(404, {"error": {"message": f"Unknown endpoint {self.path}", "type": "invalid_request_error"}})
+            return
+
+        with server.lock:
+            server.stats["requests"] += 1
+            server.in_flight += 1
+            server.stats["max_in_flight"] = max(server.stats["max_in_flight"], server.in_flight)
+            now = time.time()
+            server.request_times = [t for t in server.request_times if now - t < 60] + [now]
+            over_limit = requests_per_minute is not None and len(server.request_times) > requests_per_minute
+            fault = 'rate_limited' if over_limit else pick_fault(server.rng.random())
+            latency = sample_latency(server.rng)
+            rng = random.Random(server.rng.random())
+        try:
+            limit = requests_per_minute or 10000
+            headers = {
+                'x-ratelimit-limit-requests': str(limit),
+                'x-ratelimit-remaining-requests': str(max(limit - len(server.request_times), 0)),
+                'x-ratelimit-reset-requests': '1s'
+            }
+            if fault == 'rate_limited':
+                self.count(fault)
+                self.send_json(429, {"error": {
+                    "message": f"Rate limit reached for requests. Please try again in {rate_limit_wait}s.",
+                    "type": "requests", "code": "rate_limit_exceeded"}}, headers)
+                return
+
+            try:
+                body = json.loads(raw_body)
+            except json.JSONDecodeError as e:
+                self.send_json(400, {"error": {"message": f"Invalid JSON body: {e}", "type": "invalid_request_error"}})
+                return
+
+            time.sleep(latency)
+            content = synthetic_content(body, rng, incomplete=fault == 'incomplete')
+            finish_reason = "stop"
+            if fault == 'truncated':
+                content = content[:rng.randint(0, len(content))]
+                finish_reason = "length"
+
+            data = {
+                "id": f"chatcmpl-mock-{rng.getrandbits(48):012x}",
+                "object": "chat.completion",
+                "model": body.get("model", "mock"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}],
+                "usage": {"prompt_tokens": len(raw_body) // 4, "completion_tokens": len(content) // 4,
+                          "total_tokens": len(raw_body) // 4 + len(content) // 4}
+            }
+            encoded = json.dumps(data).encode('utf-8')
+            if fault == 'malformed':
+                encoded = encoded[:len(encoded) // 2]
+            self.count(fault or 'ok')
+            self.send_json(200, encoded, headers)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def count(self, key):
+        with self.server.lock:
+            self.server.stats[key] += 1
+
+def start_server(host=host, port=port):
+    """ Start the stand-in API in a background thread. Returns the server (server.url, server.stats, server.shutdown()) """
+    server = MockServer((host, port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+#%% Run the server
+
+if __name__ == '__main__':
+    server = MockServer((host, port))
+    print(f"Mock chat-completions API listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\nStopped. {server.stats}")
@@ -1,25 +1,343 @@
 from moviepy import VideoFileClip
+from moviepy.config import FFMPEG_BINARY
+import imageio
+import json
+import numpy as np
 import os
+import queue
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def extract_frames(video_path, output_dir, frame_duration=1.85): #Input Desired Frame Duration
+def extract_frames(video_path, output_dir, frame_duration=1.85, mode='sequential', frame_store='png',
+                   dedup_threshold=None, audio_path=None): #Input Desired Frame Duration
+    """ Returns the number of frames. With audio_path, the audio track is also saved as WAV in the same decode pass """
     os.makedirs(output_dir, exist_ok=True)
-    clip = VideoFileClip(video_path)
+    clip = VideoFileClip(video_path, audio=False)
     total_duration = clip.duration
-    times = [t for t in frange(0, total_duration, frame_duration)]
-    for idx, t in enumerate(times):
-        frame = clip.get_frame(t)
-        frame_filename = os.path.join(output_dir, f"frame_{idx + 1:04d}.png")
-        import imageio
+    times = frame_times(total_duration, frame_duration)
+    decoder = None
+    try:
+        if audio_path is not None:
+            if mode != 'sequential':
+                raise ValueError("audio_path needs mode='sequential'")
+            if not clip.reader.infos.get('audio_found'):
+                print(f"No audio track in {video_path}")
+                audio_path = None
+            decoder = decode_with_audio(video_path, clip.size, audio_path)
+            frames = iter_frames_sequential(clip, times, decoder)
+        elif mode == 'sequential':
+            frames = iter_frames_sequential(clip, times)
+        elif mode == 'seek':
+            frames = ((idx, clip.get_frame(t)) for idx, t in enumerate(times))
+        else:
+            raise ValueError(f"mode must be 'sequential' or 'seek', not '{mode}'")
+
+        # Hash each frame as it streams to the writer
+        hashes = {}
+        if dedup_threshold is not None:
+            frames = hash_frames(frames, hashes)
+
+        if frame_store == 'png':
+            write_frames(frames, png_saver(output_dir))
+        elif frame_store == 'mmap':
+            write_frame_store(frames, output_dir, times, (clip.h, clip.w, 3), frame_duration)
+        else:
+            raise ValueError(f"frame_store must be 'png' or 'mmap', not '{frame_store}'")
+    finally:
+        try:
+            # The last sample is usually decoded before the stream ends: closing the decoder drains
+            # ffmpeg (finishing the WAV) and raises here if it failed, instead of at garbage collection
+            if decoder is not None:
+                decoder.close()
+        finally:
+            clip.close()
+
+    if dedup_threshold is not None:
+        write_dedup_index(hashes, output_dir, dedup_threshold)
+    return len(times)
+
+def frame_times(total_duration, frame_duration):
+    """ TR-aligned sample times (index x TR), so long movies do not drift off the TR grid """
+    n_frames = int(total_duration / frame_duration)
+    if n_frames * frame_duration < total_duration:
+        n_frames += 1
+    return [idx * frame_duration for idx in range(n_frames)]
+
+def iter_frames_sequential(clip, times, decoded_frames=None):
+    """
+    Decode the video once as a sequential stream and yield (index, frame) only for
+    the decoded frames that moviepy's get_frame(t) would have returned for each time.
+    decoded_frames replaces moviepy's own frame iterator (see decode_with_audio).
+    """
+    fps = clip.fps
+    # Same frame number rule as moviepy's ffmpeg reader: int(fps * t + 0.00001)
+    targets = [int(fps * t + 0.00001) for t in times]
+    if decoded_frames is None:
+        decoded_frames = clip.iter_frames(fps=fps, dtype='uint8', logger=None)
+    next_idx = 0
+    for frame_number, frame in enumerate(decoded_frames):
+        while next_idx < len(targets) and targets[next_idx] <= frame_number:
+            yield next_idx, frame
+            next_idx += 1
+        if next_idx == len(targets):
+            return
+    # Rounding at the very end of the stream can leave the last sample undecoded
+    for idx in range(next_idx, len(times)):
+        yield idx, clip.get_frame(times[idx])
+
+def decode_with_audio(video_path, size, audio_path=None):
+    """
+    Single ffmpeg pass over the container: video frames go to a pipe as raw RGB (the same
+    conversion moviepy uses) while the audio track is written to audio_path as 16 kHz mono WAV.
+    """
+    width, height = size
+    cmd = [FFMPEG_BINARY, '-loglevel', 'error', '-i', video_path,
+           '-map', '0:v:0', '-f', 'image2pipe', '-pix_fmt', 'rgb24', '-vcodec', 'rawvideo', '-']
+    if audio_path is not None:
+        cmd += ['-map', '0:a:0', '-vn', '-acodec', 'pcm_s16le', '-ar', '16000', '-ac', '1', '-y', audio_path]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    frame_size = width * height * 3
+    try:
+        while True:
+            data = proc.stdout.read(frame_size)
+            if len(data) < frame_size:
+                break
+            yield np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)
+    finally:
+        # The audio output is only complete once ffmpeg reaches the end of the container
+        while proc.stdout.read(1 << 20):
+            pass
+        stderr = proc.stderr.read()
+        proc.wait()
+        if proc.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed on {video_path}: {stderr.decode(errors='replace').strip()}")
+
+def write_frames(frames, save_frame, queue_size=32):
+    """ Save (index, frame) pairs on a background thread so decoding and encoding overlap """
+    frame_queue = queue.Queue(maxsize=queue_size)
+    errors = []
+
+    def writer():
+        while True:
+            item = frame_queue.get()
+            if item is None:
+                break
+            if errors:  # Keep draining so the decoder never blocks on a full queue
+                continue
+            try:
+                save_frame(*item)
+            except Exception as e:
+                errors.append(e)
+
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    writer_thread.start()
+    try:
+        for item in frames:
+            frame_queue.put(item)
+    finally:
+        frame_queue.put(None)
+        writer_thread.join()
+    if errors:
+        raise errors[0]
+
+def png_saver(output_dir):
+    """ One frame_XXXX.png per sample (default layout) """
+    def save(idx, frame):
+        frame_filename = os.path.join(output_dir, frame_filename_for(idx))
         imageio.imwrite(frame_filename, frame)
         print(f"Saved {frame_filename}")
+    return save
+
+def frame_filename_for(idx):
+    return f"frame_{idx + 1:04d}.png"
+
+def write_frame_store(frames, output_dir, times, frame_shape, frame_duration, chunk_size=64):
+    """
+    Write all frames of a video into one memory-mapped array (FRAME_STORE_FILE, shape frames x H x W x 3)
+    plus an index (FRAME_INDEX_FILE) of frame number, timestamp and shape. Readers slice it without copies.
+    The index is written last, so a store without an index is an unfinished extraction.
+    """
+    store_path = os.path.join(output_dir, FRAME_STORE_FILE)
+    index_path = os.path.join(output_dir, FRAME_INDEX_FILE)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    store = np.lib.format.open_memmap(store_path, mode='w+', dtype=np.uint8,
+                                      shape=(len(times), *frame_shape))
+
+    def save(idx, frame):
+        if frame.shape != frame_shape:
+            raise ValueError(f"Frame {idx + 1} has shape {frame.shape}, expected {frame_shape}")
+        store[idx] = frame
+        if (idx + 1) % chunk_size == 0:  # Flush in chunks instead of per frame
+            store.flush()
+
+    write_frames(frames, save)
+    store.flush()
+    del store
 
-def frange(start, stop, step):
-    t = start
-    while t < stop:
-        yield t
-        t += step
+    index = {
+        "frame_duration": frame_duration,
+        "shape": list(frame_shape),
+        "dtype": "uint8",
+        "frames": [
+            {"frame_number": idx + 1, "frame_filename": frame_filename_for(idx), "timestamp": t}
+            for idx, t in enumerate(times)
+        ]
+    }
+    with open(index_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=4)
+    print(f"Saved {len(times)} frames to {store_path}")
+
+def dhash(frame, hash_size=8):
+    """ Difference hash: compare neighbouring cells of a (hash_size x hash_size+1) grayscale thumbnail """
+    gray = frame[..., :3].astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    rows = np.linspace(0, gray.shape[0], hash_size + 1).astype(int)
+    cols = np.linspace(0, gray.shape[1], hash_size + 2).astype(int)
+    small = np.add.reduceat(np.add.reduceat(gray, rows[:-1], axis=0), cols[:-1], axis=1)
+    small /= np.outer(np.diff(rows), np.diff(cols))
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+def hash_frames(frames, hashes):
+    """ Pass (index, frame) pairs through, recording each frame's perceptual hash in hashes """
+    for idx, frame in frames:
+        hashes[idx] = dhash(frame)
+        yield idx, frame
+
+def write_dedup_index(hashes, output_dir, threshold, hash_size=8):
+    """
+    Group consecutive near-duplicate frames into runs and save them to DEDUP_INDEX_FILE.
+    A frame joins the current run when its hash is within threshold bits of the run's first
+    frame (the representative), so slow drifts over a long shot still start new runs.
+    """
+    runs = []
+    for idx in sorted(hashes):
+        if runs and bin(hashes[idx] ^ hashes[runs[-1][0]]).count('1') <= threshold:
+            runs[-1].append(idx)
+        else:
+            runs.append([idx])
+
+    index = {
+        "hash_size": hash_size,
+        "threshold": threshold,
+        "hashes": {frame_filename_for(idx): f"{hashes[idx]:0{hash_size * hash_size // 4}x}" for idx in sorted(hashes)},
+        "runs": [
+            {"representative": frame_filename_for(run[0]),
+             "duplicates": [frame_filename_for(idx) for idx in run[1:]]}
+            for run in runs if len(run) > 1
+        ]
+    }
+    with open(os.path.join(output_dir, DEDUP_INDEX_FILE), 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=4)
+    duplicate_count = sum(len(run) - 1 for run in runs)
+    print(f"Found {duplicate_count} near-duplicate frames in {len(index['runs'])} runs")
+
+def ingest_video(video_path, output_dir, frame_duration=1.85, frame_store='png', dedup_threshold=None,
+                 context_margin=0.0, cpu_threads=4):
+    """
+    Extract frames and the audio track in one decode pass, then transcribe the WAV with step2's
+    worker function. Writes <video name>.wav/.txt/.frames.json next to the frames.
+    cpu_threads is the number of CPU threads of the Whisper model (loaded once per process).
+    """
+    from step2_audio_text_converter import transcribe_file, load_model
+    
+    audio_path = os.path.join(output_dir, os.path.splitext(os.path.basename(video_path))[0] + '.wav')
+    frame_count = extract_frames(video_path, output_dir, frame_duration, 'sequential', frame_store,
+                                 dedup_threshold, audio_path=audio_path)
+    if os.path.exists(audio_path):
+        load_model(cpu_threads)
+        item, error = transcribe_file(audio_path, frame_duration=frame_duration, context_margin=context_margin)
+        if error is not None:
+            raise RuntimeError(f"Transcription of {item} failed: {error}")
+        print(f"Transcribed {item}")
+    return frame_count
+
+def extract_frames_batch(video_folder, output_root, frame_duration=1.85, mode='sequential', frame_store='png',
+                         dedup_threshold=None, ingest_audio=False, workers=None, manifest_file='frames_manifest.txt',
+                         cpu_threads=4):
+    """
+    Extract frames for every video in video_folder into output_root/<video name>/ using a process pool.
+    Finished videos are appended to a manifest ("video<TAB>frame count"), so an interrupted run resumes.
+    With ingest_audio, each worker runs ingest_video and keeps its Whisper model (cpu_threads threads)
+    between videos; workers defaults to one per cpu_threads cores, so the models do not oversubscribe the CPU.
+    """
+    if workers is None:
+        workers = max(1, os.cpu_count() // cpu_threads) if ingest_audio else os.cpu_count()
+    os.makedirs(output_root, exist_ok=True)
+    manifest_path = os.path.join(output_root, manifest_file)
+
+    # Read the manifest of videos already extracted
+    completed = {}
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                video, _, frame_count = line.rstrip('\n').partition('\t')
+                if video:
+                    completed[video] = int(frame_count)
+    except FileNotFoundError:
+        pass
+
+    videos = sorted(item for item in os.listdir(video_folder)
+                    if item.lower().endswith(VIDEO_EXTENSIONS) and item not in completed)
+    print(f"Videos to extract: {len(videos)} ({len(completed)} already in manifest)")
+
+    error_count = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for video in videos:
+            video_output_dir = os.path.join(output_root, os.path.splitext(video)[0])
+            if ingest_audio:
+                future = executor.submit(ingest_video, os.path.join(video_folder, video),
+                                         video_output_dir, frame_duration, frame_store, dedup_threshold,
+                                         cpu_threads=cpu_threads)
+            else:
+                future = executor.submit(extract_frames, os.path.join(video_folder, video),
+                                         video_output_dir, frame_duration, mode, frame_store, dedup_threshold)
+            futures[future] = video
+
+        for future in as_completed(futures):
+            video = futures[future]
+            try:
+                frame_count = future.result()
+            except Exception as e:
+                error_count += 1
+                print(f"✗ Error extracting {video}: {e}")
+                continue
+            # Only the parent process writes the manifest, one line per finished video
+            with open(manifest_path, 'a', encoding='utf-8') as f:
+                f.write(f"{video}\t{frame_count}\n")
+            completed[video] = frame_count
+            print(f"✓ {video}: {frame_count} frames")
+
+    print(f"Extracted {len(videos) - error_count} videos, {error_count} errors")
+    return completed
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv', '.m4v', '.webm')
+FRAME_STORE_FILE = 'frames.npy'
+FRAME_INDEX_FILE = 'frames_index.json'
+DEDUP_INDEX_FILE = 'frames_dedup.json'
 
 video_path = "" #CHANGE
 output_dir = "frames_output"   # Output folder
+extraction_mode = 'sequential'   # 'sequential' (decode once, recommended) or 'seek' (get_frame per sample)
+frame_store = 'png'   # 'png' (one file per frame) or 'mmap' (one memory-mapped frames.npy + frames_index.json per video)
+dedup_threshold = None   # Max differing hash bits (of 64) for near-duplicate frames, e.g. 5; None disables frames_dedup.json
+ingest_audio = False   # Also save the audio track as WAV in the same decode pass and transcribe it with step2
+ingest_cpu_threads = 4   # CPU threads of each Whisper model (step2's cpu_threads_per_worker)
+
+# Batch mode: set video_folder to extract every video in it into output_dir/<video name>/
+video_folder = "" #CHANGE for batch mode
+batch_workers = None   # Number of videos extracted in parallel; None = all cores, or cores // ingest_cpu_threads with ingest_audio
 
-extract_frames(video_path, output_dir)
\ No newline at end of file
+if __name__ == '__main__':
+    if video_folder:
+        extract_frames_batch(video_folder, output_dir, mode=extraction_mode, frame_store=frame_store,
+                             dedup_threshold=dedup_threshold, ingest_audio=ingest_audio, workers=batch_workers,
+                             cpu_threads=ingest_cpu_threads)
+    elif ingest_audio:
+        ingest_video(video_path, output_dir, frame_store=frame_store, dedup_threshold=dedup_threshold,
+                     cpu_threads=ingest_cpu_threads)
+    else:
+        extract_frames(video_path, output_dir, mode=extraction_mode, frame_store=frame_store,
+                       dedup_threshold=dedup_threshold)
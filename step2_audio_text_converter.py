@@ -1,68 +1,149 @@
 import os
+import json
 import time
+from functools import partial
+from multiprocessing import Pool
 from faster_whisper import WhisperModel
 import pandas as pd
 
 #%% Change parameters
 folder_path = ""
 
+# Parallel transcription: each worker process loads its own model once
+transcribe_workers = 1  # 1 = transcribe in this process
+cpu_threads_per_worker = 4  # CPU threads used by each model
+
+# Per-frame transcript index (<audio name>.frames.json) aligned to step1's frame grid
+frame_duration = 1.85  # Must match the frame_duration used in step1
+transcript_context_margin = 0.0  # Seconds of speech before/after each frame window included in its slice
+
 #%% Initialize local Whisper model
-print("Loading Whisper model (first time may take a few minutes)...")
-model = WhisperModel("base", device="cpu", compute_type="int8")
-print("✓ Model loaded!\n")
+
+model = None
+
+def load_model(cpu_threads=0):
+    """ Load the Whisper model once per process (also used as the worker pool initializer) """
+    global model
+    if model is None:
+        print("Loading Whisper model (first time may take a few minutes)...")
+        model = WhisperModel("base", device="cpu", compute_type="int8", cpu_threads=cpu_threads)
+        print("✓ Model loaded!\n")
+    return model
 
 #%% Transcribe functions
 
+def transcribe_segments(file_path):
+    """ Transcribe audio and keep the segment timestamps. Returns (segments, audio duration) """
+    segments, info = load_model().transcribe(file_path, beam_size=5)
+    segments = [{"start": segment.start, "end": segment.end, "text": segment.text} for segment in segments]
+    return segments, info.duration
+
 def transcribe_audio(file_path):
     """ Transcribe audio using local Faster Whisper """
-    segments, info = model.transcribe(file_path, beam_size=5)
+    segments, duration = transcribe_segments(file_path)
     
     # Combine all segments into full text
-    transcript = " ".join([segment.text for segment in segments])
+    transcript = " ".join([segment["text"] for segment in segments])
     return transcript
 
-def process_audio_files(folder_path, processed_file='audio_processed.txt'):
+def frame_transcript_index(segments, duration, frame_duration, context_margin=0.0):
+    """
+    Slice the transcript onto step1's frame grid: frame k is sampled at k x frame_duration and
+    gets the speech of every segment overlapping [k x frame_duration, (k+1) x frame_duration],
+    widened by context_margin seconds on both sides.
+    """
+    n_frames = int(duration / frame_duration)
+    if n_frames * frame_duration < duration:
+        n_frames += 1
+    
+    frames = []
+    for idx in range(n_frames):
+        start = idx * frame_duration
+        end = min((idx + 1) * frame_duration, duration)
+        text = " ".join(segment["text"].strip() for segment in segments
+                        if segment["end"] > start - context_margin and segment["start"] < end + context_margin)
+        frames.append({"frame_number": idx + 1, "start": start, "end": end, "text": text})
+    return frames
+
+def transcribe_file(item_path, frame_duration=frame_duration, context_margin=transcript_context_margin):
+    """
+    Transcribe one audio file and save the transcript (.txt) and per-frame index (.frames.json)
+    next to it. Returns (item, error message or None)
+    """
+    item = os.path.basename(item_path)
+    try:
+        segments, duration = transcribe_segments(item_path)
+        transcript_text = " ".join([segment["text"] for segment in segments])
+        
+        # Save transcription as a text file
+        base_name = os.path.splitext(item_path)[0]
+        with open(base_name + '.txt', 'w', encoding='utf-8') as text_file:
+            text_file.write(transcript_text)
+        
+        # Save the TR-aligned slices for step3
+        index = {
+            "frame_duration": frame_duration,
+            "context_margin": context_margin,
+            "segments": segments,
+            "frames": frame_transcript_index(segments, duration, frame_duration, context_margin)
+        }
+        with open(base_name + '.frames.json', 'w', encoding='utf-8') as index_file:
+            json.dump(index, index_file, ensure_ascii=False, indent=4)
+        return item, None
+    except Exception as e:
+        return item, str(e)
+
+def process_audio_files(folder_path, processed_file='audio_processed.txt',
+                        workers=1, cpu_threads=cpu_threads_per_worker,
+                        frame_duration=frame_duration, context_margin=transcript_context_margin):
     start_time = time.time()
     
-    # Read the list of files already processed
+    # Read the journal of files already processed
     try:
         with open(processed_file, 'r') as f:
-            processed_files = [line.strip() for line in f]
+            processed_files = {line.strip() for line in f}
     except FileNotFoundError:
-        processed_files = []
+        processed_files = set()
 
     processed_count = 0
     error_count = 0
     
-    # Loop through all items in the folder
+    # Collect the audio files in the folder that are not processed yet
+    pending_files = []
     for item in os.listdir(folder_path):
         item_path = os.path.join(folder_path, item)
-        
-        # Check if it's an audio file
         if os.path.isfile(item_path) and item.lower().endswith(('.mp3', '.wav', '.m4a')) and item not in processed_files:
-            print(f"\n🎵 Processing: {item}")
-            
-            try:
-                # Transcribe the file
-                transcript_text = transcribe_audio(item_path)          
-                
-                # Save transcription as a text file
-                base_name = os.path.splitext(item)[0]
-                text_file_path = os.path.join(folder_path, base_name + '.txt')
-                
-                with open(text_file_path, 'w', encoding='utf-8') as text_file:
-                    text_file.write(transcript_text)
-                
-                # Save progress
-                with open(processed_file, 'a', encoding='utf-8') as f:
-                    f.write(item + '\n')
-                
-                processed_count += 1
-                print(f"✓ Saved: {base_name}.txt")
-                
-            except Exception as e:
-                error_count += 1
-                print(f"✗ Error: {e}")
+            pending_files.append(item_path)
+    
+    print(f"🎵 Files to transcribe: {len(pending_files)} ({len(processed_files)} already processed)")
+    
+    # Workers pull files from the pool's shared task queue; only this process writes the journal
+    transcribe = partial(transcribe_file, frame_duration=frame_duration, context_margin=context_margin)
+    if workers > 1:
+        pool = Pool(processes=workers, initializer=load_model, initargs=(cpu_threads,))
+        results = pool.imap_unordered(transcribe, pending_files)
+    else:
+        pool = None
+        load_model(cpu_threads)
+        results = map(transcribe, pending_files)
+    
+    try:
+        with open(processed_file, 'a', encoding='utf-8') as journal:
+            for item, error in results:
+                if error is None:
+                    # Save progress
+                    journal.write(item + '\n')
+                    journal.flush()
+                    processed_files.add(item)
+                    processed_count += 1
+                    print(f"✓ Saved: {os.path.splitext(item)[0]}.txt")
+                else:
+                    error_count += 1
+                    print(f"✗ Error ({item}): {error}")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
                 
     total_time = time.time() - start_time
     print(f"\n{'='*60}")
@@ -83,9 +164,10 @@ def load_transcriptions_to_dataframe(folder_path):
     
     return pd.DataFrame(data)
 
-# Start processing
-process_audio_files(folder_path)
-
-# Load results
-df_transcriptions = load_transcriptions_to_dataframe(folder_path)
-print(f"\n📊 Loaded {len(df_transcriptions)} transcriptions into DataFrame")
\ No newline at end of file
+if __name__ == '__main__':
+    # Start processing
+    process_audio_files(folder_path, workers=transcribe_workers)
+    
+    # Load results
+    df_transcriptions = load_transcriptions_to_dataframe(folder_path)
+    print(f"\n📊 Loaded {len(df_transcriptions)} transcriptions into DataFrame")
\ No newline at end of file
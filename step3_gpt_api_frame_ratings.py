@@ -1,9 +1,19 @@
 import os
 import base64
+import csv
 import json
+import hashlib
+import io
 import http.client
 import time
 import re
+import asyncio
+import threading
+import uuid
+import logging
+from logging.handlers import RotatingFileHandler
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 
 #%% Change parameters
 
@@ -15,6 +25,64 @@ last_round = 5
 folder_path = r"" #CHANGE
 output_folder_base = r""#CHANGE
 
+# Rate only the first frame of each near-duplicate run from step1's frames_dedup.json and copy its ratings
+use_dedup = True
+
+# Send each frame only its own slice of step2's <audio>.frames.json instead of the whole transcript
+use_frame_transcripts = True
+
+# Consecutive frames rated in one request, each answered in its own labelled block (1 = one frame per request)
+frames_per_request = 1
+
+# Answer format: 'lines' ("Feature: Number" per line), 'json_array' (integers in FEATURES order)
+# or 'json_schema' (the same array, enforced by a response schema)
+output_format = 'lines'
+
+# Frames are shrunk so their longest edge is at most image_max_edge pixels (None sends them at full size; needs Pillow)
+image_max_edge = None
+image_format = 'png'  # 'png' or 'jpeg'
+jpeg_quality = 85
+
+# Ready-to-send image data URLs are stored here once per frame and reused by every round ('' encodes them every time)
+image_cache_folder = ''
+
+#%% API settings
+
+api_url = "https://api.openai.com/v1/chat/completions"  # Point to a local mock server for testing
+api_key = ''  # ← REPLACE WITH YOUR ACTUAL KEY
+model_name = "gpt-4.1"  # Valid model that supports vision
+
+# Number of frame requests kept in flight at the same time (1 = one frame at a time)
+max_in_flight = 8
+
+# Attempts per frame for errors and incomplete responses (rate-limit waits do not count as attempts)
+max_attempts = 3
+max_rate_limit_waits = 20
+request_timeout = 600  # Seconds
+
+# 'realtime' sends chat-completion requests directly; 'batch' rates everything offline through the Batch API
+rating_mode = 'realtime'
+concurrent_rounds = True  # Realtime mode: rate all rounds at once under the shared limits instead of one round after another
+batch_poll_interval = 60  # Seconds between batch status checks
+batch_max_requests = 50000  # Batch API limits per input file
+batch_max_bytes = 190 * 1024 * 1024
+
+# Every frame result is appended to output_{round}_{extra_round}.jsonl as soon as it arrives (read by step4)
+journal_fsync_every = 20  # Frames between fsyncs of the journal
+write_video_json = False  # Also write the old one-object-per-video output_{round}_{extra_round}.json
+
+# On-disk cache of valid responses, keyed by a hash of the request (image, transcripts, prompt, model), the round and the extra round
+response_cache_folder = ''  # '' disables the cache
+response_cache_max_bytes = 2 * 1024 ** 3  # Least recently used responses are deleted above this size
+bypass_response_cache = False  # True asks the API for a fresh sample and replaces the cached one
+
+# One JSON line of metrics per request (rotated), and a live throughput summary every progress_interval seconds
+metrics_file = ''  # '' disables the metrics file
+#metrics_file = f'{output_folder_base}_metrics.jsonl'  # ACTIVATE THIS TO LOG EVERY REQUEST NEXT TO THE OUTPUT FOLDERS
+metrics_max_bytes = 50 * 1024 * 1024
+metrics_backup_count = 5
+progress_interval = 30
+
 
 #%% Extra round
 
@@ -27,11 +95,67 @@ previous_extra_round = extra_round - 1
 # Extra round
 #folder_path = folder_path + f'_round_{first_round}_{previous_extra_round}'  # ACTIVATE THIS IF YOU WANT TO RUN EXTRA RUN
 
+# Or re-rate only the frames step4 listed in its frames_to_reprocess_{round}_{extra}.csv manifest, taken from folder_path
+# ({round_number} is replaced by the number of each round; '' rates every frame)
+reprocess_manifest = ''
+#reprocess_manifest = f'{output_folder_base}_{{round_number}}/frames_to_reprocess_{{round_number}}_{previous_extra_round}.csv'  # ACTIVATE THIS INSTEAD TO RE-RATE ONLY THE FAILED FRAMES
+
 #%% Validation function
 
-def validate_response(response_data, expected_feature_count=138):
+# Header line that starts the ratings of one frame in a response to a packed request, e.g. "### Frame 12"
+PACK_HEADER_PATTERN = re.compile(r'^[#*\s]*Frame\s+(\d+)[*:\s]*$', re.MULTILINE | re.IGNORECASE)
+
+def pack_label(frame):
+    return f"Frame {frame['frame_number']}"
+
+# One "Feature: Number" line of an answer in the 'lines' format
+FEATURE_LINE_PATTERN = re.compile(r'^([^:]+):\s*(\d+)\s*$')
+
+def parse_feature_lines(content, truncated=False):
+    """ {feature: rating} of the "Feature: Number" lines naming one of FEATURES; the last line of a truncated answer is dropped """
+    lines = content.strip().splitlines()
+    if truncated:
+        lines = lines[:-1]
+    ratings = {}
+    for line in lines:
+        match = FEATURE_LINE_PATTERN.match(line.strip())
+        if match and match.group(1).strip() in FEATURES:
+            ratings[match.group(1).strip()] = int(match.group(2))
+    return ratings
+
+def is_json_content(content):
+    return content.lstrip()[:1] in ('[', '{')
+
+def decode_ratings(content):
+    """ Ratings list of a 'json_array' or 'json_schema' answer (a JSON array, or an object holding it under "ratings") """
+    ratings = json.loads(content)
+    if isinstance(ratings, dict):
+        ratings = ratings.get("ratings")
+    return ratings
+
+def split_pack_blocks(content):
+    """ Split the content of a packed response into {'Frame <number>': ratings text} """
+    if is_json_content(content):
+        # JSON answers map every frame label to its ratings array
+        try:
+            frames = json.loads(content)
+        except json.JSONDecodeError:
+            return {}
+        if not isinstance(frames, dict):
+            return {}
+        return {label: json.dumps(ratings) for label, ratings in frames.items()}
+    
+    headers = list(PACK_HEADER_PATTERN.finditer(content))
+    blocks = {}
+    for header, next_header in zip(headers, headers[1:] + [None]):
+        end = next_header.start() if next_header is not None else len(content)
+        blocks[f"Frame {int(header.group(1))}"] = content[header.end():end]
+    return blocks
+
+def validate_response(response_data, expected_feature_count=138, pack=None):
     """
     Check if the API response contains all expected features.
+    With pack (a frame label of a packed request) only that frame's block is checked.
     Returns (is_valid, feature_count, error_message)
     """
     try:
@@ -42,19 +166,39 @@ def validate_response(response_data, expected_feature_count=138):
             return False, 0, "No choices in response"
         
         content = response_data["choices"][0]["message"]["content"]
+        is_last_block = True
+        if pack is not None:
+            blocks = split_pack_blocks(content)
+            if pack not in blocks:
+                return False, 0, f"No ratings block for {pack}"
+            content = blocks[pack]
+            is_last_block = pack == list(blocks)[-1]
         
-        # Count how many features are in the response
-        # Each feature should appear as "Feature: Number"
-        feature_pattern = re.compile(r'^[^:]+:\s*\d+\s*$', re.MULTILINE)
-        features_found = feature_pattern.findall(content)
-        feature_count = len(features_found)
+        if output_format != 'lines':
+            # One JSON decode instead of matching every line
+            try:
+                ratings = decode_ratings(content)
+            except json.JSONDecodeError as e:
+                return False, 0, f"Invalid JSON ratings: {e}"
+            if not isinstance(ratings, list) or not all(isinstance(rating, int) for rating in ratings):
+                return False, 0, "Ratings are not a JSON array of integers"
+            if len(ratings) != expected_feature_count:
+                return False, len(ratings), f"Incomplete response: {len(ratings)}/{expected_feature_count} features"
+            return True, len(ratings), "Valid"
+        
+        # Count the features of the response: "Feature: Number" lines naming one of FEATURES
+        # (misspelled or decorated names are missing features, as they are for step4)
+        ratings = parse_feature_lines(content)
+        feature_count = len(ratings)
         
         if feature_count < expected_feature_count:
-            return False, feature_count, f"Incomplete response: {feature_count}/{expected_feature_count} features"
+            missing = [feature for feature in FEATURES if feature not in ratings]
+            return False, feature_count, (f"Incomplete response: {feature_count}/{expected_feature_count} features "
+                                          f"(missing e.g. {', '.join(missing[:3])})")
         
-        # Check if response was truncated
+        # Check if response was truncated (in a packed response only the last block can be cut off)
         finish_reason = response_data["choices"][0].get("finish_reason", "")
-        if finish_reason == "length":
+        if finish_reason == "length" and is_last_block:
             return False, feature_count, "Response truncated (hit token limit)"
         
         return True, feature_count, "Valid"
@@ -70,10 +214,976 @@ def encode_image(image_path):
         encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
     return f"data:image/png;base64,{encoded_string}"
 
-# Process all images in a folder and save responses to a JSON file
-def process_media_files(folder_path, round_number, output_folder='./output_data'):
-    start_time = time.time()  # Start timing
+# Frame store written by step1 with frame_store='mmap' (one frames.npy + frames_index.json per video)
+FRAME_STORE_FILE = 'frames.npy'
+FRAME_INDEX_FILE = 'frames_index.json'
+DEDUP_INDEX_FILE = 'frames_dedup.json'
+
+TRANSCRIPT_INDEX_SUFFIX = '.frames.json'
+
+def load_transcript_slices(index_path):
+    """ Map frame number to the transcript slice step2 aligned with that frame """
+    with open(index_path, 'r', encoding='utf-8') as f:
+        transcript_index = json.load(f)
+    return {frame["frame_number"]: frame["text"] for frame in transcript_index["frames"]}
+
+def load_duplicate_map(subfolder_path):
+    """ Map each near-duplicate frame filename to the representative frame of its run """
+    with open(os.path.join(subfolder_path, DEDUP_INDEX_FILE), 'r', encoding='utf-8') as f:
+        dedup_index = json.load(f)
+    return {duplicate: run["representative"]
+            for run in dedup_index["runs"] for duplicate in run["duplicates"]}
+
+def load_frame_store(subfolder_path):
+    """ Open a step1 frame store read-only; frames are sliced from the memory map without copying """
+    import numpy as np
+    with open(os.path.join(subfolder_path, FRAME_INDEX_FILE), 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    frames = np.load(os.path.join(subfolder_path, FRAME_STORE_FILE), mmap_mode='r')
+    return frames, index
+
+# Function to encode a frame taken from the frame store
+def encode_frame_array(frame):
+    import imageio.v3 as iio
+    encoded_string = base64.b64encode(iio.imwrite("<bytes>", frame, extension=".png")).decode('utf-8')
+    return f"data:image/png;base64,{encoded_string}"
+
+def preprocess_image(image):
+    """ Resize a PIL image to image_max_edge and encode it as image_format. Returns a data URL """
+    from PIL import Image
+    if image_max_edge is not None and max(image.size) > image_max_edge:
+        image.thumbnail((image_max_edge, image_max_edge), Image.LANCZOS)
+    buffer = io.BytesIO()
+    if image_format == 'jpeg':
+        image.convert('RGB').save(buffer, format='JPEG', quality=jpeg_quality)
+        mime_type = 'image/jpeg'
+    else:
+        image.save(buffer, format='PNG')
+        mime_type = 'image/png'
+    encoded_string = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    return f"data:{mime_type};base64,{encoded_string}"
+
+def image_cache_path(video, frame):
+    """ Cache file of a frame's data URL, keyed by the source file (path, size, mtime) and the preprocessing settings """
+    if video["frame_store"] is not None:
+        source_path = os.path.join(video["path"], FRAME_STORE_FILE)
+    else:
+        source_path = os.path.join(video["path"], frame["frame_filename"])
+    stat = os.stat(source_path)
+    key = json.dumps([os.path.abspath(source_path), stat.st_size, stat.st_mtime_ns, frame["store_index"],
+                      image_max_edge, image_format, jpeg_quality if image_format == 'jpeg' else None])
+    key = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    return os.path.join(image_cache_folder, key[:2], f'{key}.txt')
+
+def frame_data_url(video, frame):
+    """ Data URL of one frame: taken from the image cache, or read, preprocessed if needed and encoded """
+    cache_path = None
+    if image_cache_folder:
+        cache_path = image_cache_path(video, frame)
+        try:
+            with open(cache_path, 'r', encoding='ascii') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+    
+    preprocess = image_max_edge is not None or image_format != 'png'
+    if video["frame_store"] is not None:
+        frame_array = video["frame_store"][frame["store_index"]]
+        if preprocess:
+            from PIL import Image
+            data_url = preprocess_image(Image.fromarray(frame_array))
+        else:
+            data_url = encode_frame_array(frame_array)
+    else:
+        image_path = os.path.join(video["path"], frame["frame_filename"])
+        if preprocess:
+            from PIL import Image
+            with Image.open(image_path) as image:
+                image.load()
+                data_url = preprocess_image(image)
+        else:
+            data_url = encode_image(image_path)
+    
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = f'{cache_path}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'w', encoding='ascii') as f:
+            f.write(data_url)
+        os.replace(temp_path, cache_path)
+    return data_url
+
+# Collect the frames, transcripts and near-duplicate runs of one video folder
+def collect_video_inputs(subfolder, subfolder_path, excluded_files):
+    subfolder_files = os.listdir(subfolder_path)
+    video = {
+        "subfolder": subfolder,
+        "path": subfolder_path,
+        "frames": [],
+        "frame_store": None,
+        "audio_contents": [],
+        "frame_transcripts": [],
+        "duplicate_of": {}
+    }
+    
+    # PNG files, or the frame store if step1 wrote one
+    if FRAME_INDEX_FILE in subfolder_files:
+        video["frame_store"], frame_index = load_frame_store(subfolder_path)
+        frames = [(frame["frame_filename"], store_index) for store_index, frame in enumerate(frame_index["frames"])]
+    else:
+        frames = [(filename, None) for filename in subfolder_files if filename.lower().endswith('.png')]
+    
+    # Sort image files to maintain temporal order
+    frames.sort()
+    video["frames"] = [
+        {"frame_number": frame_idx + 1, "frame_filename": frame_filename, "store_index": store_index}
+        for frame_idx, (frame_filename, store_index) in enumerate(frames)
+    ]
+    
+    if use_dedup and DEDUP_INDEX_FILE in subfolder_files:
+        video["duplicate_of"] = load_duplicate_map(subfolder_path)
+    
+    # Transcripts that have a per-frame index are sent as slices instead of as a whole
+    sliced_transcripts = set()
+    if use_frame_transcripts:
+        sliced_transcripts = {filename[:-len(TRANSCRIPT_INDEX_SUFFIX)] + '.txt' for filename in subfolder_files
+                              if filename.endswith(TRANSCRIPT_INDEX_SUFFIX)}
+    
+    for filename in subfolder_files:
+        file_path = os.path.join(subfolder_path, filename)
+        
+        if filename.endswith(TRANSCRIPT_INDEX_SUFFIX) and use_frame_transcripts:
+            if filename[:-len(TRANSCRIPT_INDEX_SUFFIX)] + '.txt' not in excluded_files:
+                video["frame_transcripts"].append(load_transcript_slices(file_path))
+            
+        if filename.lower().endswith('.txt') and filename not in sliced_transcripts:
+            if filename not in excluded_files:
+                with open(file_path, 'r', encoding='utf-8') as text_file:
+                    transcription_text = text_file.read()
+                video["audio_contents"].append({
+                    "type": "text",
+                    "text": transcription_text
+                })
     
+    return video
+
+# Instruction added after the prompt when several frames are packed into one request
+pack_instruction = """
+The images below are consecutive frames of the same video. Each image is preceded by a line "### Frame <number>".
+Rate every frame separately.
+"""
+
+def output_instruction(packed, feature_count=None):
+    """ Answer format instruction added after the prompt, or None when the prompt's own format is used """
+    if output_format == 'lines':
+        if packed:
+            return 'Start the ratings of each frame with its "### Frame <number>" line, followed by all of the features above in the format above.'
+        return None
+    ratings = (f"a JSON array of {feature_count or len(FEATURES)} integers: the ratings of the features above in the order they are listed, "
+               f"without the feature names")
+    if packed:
+        return (f'Instead of "Feature: Number" lines, answer with only a JSON object that has one key per frame ("Frame <number>"), '
+                f'each holding {ratings}.')
+    if output_format == 'json_schema':
+        return f'Instead of "Feature: Number" lines, answer with only a JSON object whose "ratings" key holds {ratings}.'
+    return f'Instead of "Feature: Number" lines, answer with only {ratings}.'
+
+def response_format(frames):
+    """ response_format of the request body, or None """
+    ratings_schema = {"type": "array", "items": {"type": "integer"}}
+    if output_format == 'json_schema':
+        if len(frames) == 1:
+            properties = {"ratings": ratings_schema}
+        else:
+            properties = {pack_label(frame): ratings_schema for frame in frames}
+        return {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "frame_ratings",
+                "strict": True,
+                "schema": {
+                    "type": "object",
+                    "properties": properties,
+                    "required": list(properties),
+                    "additionalProperties": False
+                }
+            }
+        }
+    if output_format == 'json_array' and len(frames) > 1:
+        return {"type": "json_object"}
+    return None
+
+def frame_contents(video, frame):
+    """ Image of one frame followed by the transcript slices overlapping it """
+    base64_image = frame_data_url(video, frame)
+    image_content = {
+        "type": "image_url",
+        "image_url": {"url": base64_image}
+    }
+    
+    # Transcript slices overlapping this frame
+    frame_audio_contents = [
+        {"type": "text", "text": slices.get(frame["frame_number"]) or "[no speech]"}
+        for slices in video["frame_transcripts"]
+    ]
+    return image_content, frame_audio_contents
+
+def features_prompt(features):
+    """ The prompt with its feature list (and feature count) cut down to the given features """
+    prompt_head = prompt.split("List of Features:")[0].replace(str(len(FEATURES)), str(len(features)))
+    return prompt_head + "List of Features: \n" + "".join(f"{feature}:?\n" for feature in features)
+
+# Build the request body for a list of frames: prompt, image(s) and transcripts
+# With features, only those features are asked for (follow-up for the features missing from an answer)
+def build_request_body(video, frames, features=None):
+    content = [
+        {
+            "type": "text",
+            "text": prompt if features is None else features_prompt(features)
+        }
+    ]
+    if len(frames) > 1:
+        content.append({"type": "text", "text": pack_instruction})
+    instruction = output_instruction(packed=len(frames) > 1, feature_count=len(features) if features else None)
+    if instruction is not None:
+        content.append({"type": "text", "text": instruction})
+    if len(frames) == 1:
+        # Build payload with single frame + audio transcripts
+        image_content, frame_audio_contents = frame_contents(video, frames[0])
+        content += [image_content, *video["audio_contents"], *frame_audio_contents]
+    else:
+        # The static part (prompt, instructions, whole transcripts) comes first so prompt caching can reuse it
+        content += video["audio_contents"]
+        for frame in frames:
+            image_content, frame_audio_contents = frame_contents(video, frame)
+            content += [{"type": "text", "text": f"### {pack_label(frame)}"}, image_content, *frame_audio_contents]
+    
+    request_body = {
+        "model": model_name,
+        "messages": [
+            {
+                "role": "user",
+                "content": content
+            }
+        ],
+        "max_tokens": min(8192 * len(frames), 32768)  # 8192 tokens per frame for the 138 ratings of each packed frame, capped at the 32768 output tokens a request may ask for
+    }
+    frames_response_format = response_format(frames)
+    if frames_response_format is not None:
+        request_body["response_format"] = frames_response_format
+    return request_body
+
+def build_payload(video, frames):
+    return json.dumps(build_request_body(video, frames))
+
+def needs_request(video, frame, journal):
+    """ True for a frame that is not journaled and is not a near-duplicate (unless its representative's journaled result is invalid) """
+    if journal.get(video["subfolder"], frame["frame_filename"]) is not None:
+        return False
+    representative = video["duplicate_of"].get(frame["frame_filename"])
+    if representative is None:
+        return True
+    representative_record = journal.get(video["subfolder"], representative)
+    return representative_record is not None and "validation_error" in representative_record
+
+def frame_packs(video, journal):
+    """ Split the frames that need a request into packs of consecutive frames """
+    requested = [frame for frame in video["frames"] if needs_request(video, frame, journal)]
+    return [requested[i:i + frames_per_request] for i in range(0, len(requested), frames_per_request)]
+
+#%% Rate limiting
+
+def parse_duration(value):
+    """ Parse rate-limit reset values such as '1s', '6m0s', '20ms' or '1h2m3.5s' into seconds """
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    matches = re.findall(r'([\d.]+)(ms|h|m|s)', value or '')
+    return sum(float(number) * units[unit] for number, unit in matches) if matches else None
+
+def parse_wait_time(message, headers):
+    """ Seconds to wait after a rate-limit error: 'try again in Xs' in the message, else Retry-After """
+    wait_match = re.search(r'try again in ([\d.]+)\s*(ms|s)', message)
+    if wait_match:
+        wait_time = float(wait_match.group(1)) * (0.001 if wait_match.group(2) == 'ms' else 1.0)
+        return wait_time + 1  # Add 1 second buffer
+    try:
+        return float(headers.get('retry-after')) + 1
+    except (TypeError, ValueError):
+        return 10  # Default wait
+
+class TokenBucket:
+    """
+    Token bucket whose capacity and refill rate come from the API's x-ratelimit-* headers.
+    Until the first headers arrive the limit is unknown and nothing is throttled.
+    """
+    def __init__(self):
+        self.capacity = None
+        self.rate = None  # Tokens per second
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    def wait_time(self, cost, now):
+        """ Seconds until cost tokens are available (0 = available now) """
+        if self.rate is None:
+            return 0.0
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        cost = min(cost, self.capacity)
+        return 0.0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+
+    def take(self, cost):
+        if self.rate is not None:
+            self.tokens -= min(cost, self.capacity)
+
+    def sync(self, limit, remaining, reset_seconds):
+        """ Adopt the server's view of the window: limit, remaining budget and time until it is full again """
+        self.capacity = float(limit)
+        self.tokens = min(float(remaining), self.capacity)
+        if reset_seconds and limit > remaining:
+            self.rate = (limit - remaining) / reset_seconds
+        else:
+            self.rate = limit / 60.0  # OpenAI limits are per minute
+        self.updated = time.monotonic()
+
+class RateLimiter:
+    """ Request and token buckets shared by all in-flight requests, plus a global pause after 429s """
+    def __init__(self):
+        self.requests = TokenBucket()
+        self.tokens = TokenBucket()
+        self.tokens_per_request = 0.0  # Running average of usage.total_tokens
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()  # Waiters are served in order
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                wait = max(self.paused_until - now,
+                           self.requests.wait_time(1, now),
+                           self.tokens.wait_time(self.tokens_per_request, now))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.requests.take(1)
+            self.tokens.take(self.tokens_per_request)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers):
+        for bucket, kind in ((self.requests, 'requests'), (self.tokens, 'tokens')):
+            try:
+                limit = int(headers[f'x-ratelimit-limit-{kind}'])
+                remaining = int(headers[f'x-ratelimit-remaining-{kind}'])
+            except (KeyError, ValueError):
+                continue
+            bucket.sync(limit, remaining, parse_duration(headers.get(f'x-ratelimit-reset-{kind}')))
+
+    def observe_usage(self, response_data):
+        total_tokens = response_data.get("usage", {}).get("total_tokens")
+        if total_tokens:
+            if self.tokens_per_request:
+                self.tokens_per_request = 0.8 * self.tokens_per_request + 0.2 * total_tokens
+            else:
+                self.tokens_per_request = float(total_tokens)
+
+#%% Response cache
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of valid API responses, one JSON file per request. The key is a
+    hash of the exact request payload and a sample index (the round), so every round keeps its own
+    sample. Files are touched when read and the least recently used ones are deleted once the cache
+    grows beyond max_bytes. With bypass=True nothing is read, but fresh responses are still stored.
+    """
+    def __init__(self, folder, max_bytes, bypass=False):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.entries = {}  # path -> (last use, size)
+        os.makedirs(folder, exist_ok=True)
+        for root, _, files in os.walk(folder):
+            for name in files:
+                if name.endswith('.json'):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    self.entries[path] = (stat.st_mtime, stat.st_size)
+        self.size = sum(size for _, size in self.entries.values())
+
+    @staticmethod
+    def key(payload, sample_index, extra_round=0):
+        digest = hashlib.sha256(payload.encode('utf-8'))
+        digest.update(f'\0{sample_index}'.encode('utf-8'))
+        # An extra round re-rates frames on purpose, so it never reuses the responses of an earlier round
+        if extra_round:
+            digest.update(f'\0extra{extra_round}'.encode('utf-8'))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.folder, key[:2], f'{key}.json')
+
+    def get(self, key):
+        if self.bypass:
+            return None
+        path = self.path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                response = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self.lock:
+                self.misses += 1
+            return None
+        now = time.time()
+        with self.lock:
+            self.hits += 1
+            # Touched under the lock, so a concurrent put cannot evict the file in between
+            # (an entry evicted since the read is not touched; the response read is still returned)
+            if path in self.entries:
+                self.entries[path] = (now, self.entries[path][1])
+                try:
+                    os.utime(path, (now, now))  # The modification time keeps the LRU order across runs
+                except FileNotFoundError:
+                    pass
+        return response
+
+    def put(self, key, response):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(response, ensure_ascii=False).encode('utf-8')
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        with self.lock:
+            previous = self.entries.pop(path, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self.entries[path] = (time.time(), len(data))
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """ Delete least recently used responses until the cache is back under 90% of max_bytes """
+        for path, (last_use, size) in sorted(self.entries.items(), key=lambda entry: entry[1][0]):
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            del self.entries[path]
+            self.size -= size
+
+    def print_summary(self):
+        print(f"Response cache: {self.hits} hits, {self.misses} misses, "
+              f"{len(self.entries)} responses ({self.size / 1024 ** 2:.1f} MB)")
+
+def open_response_cache():
+    """ The response cache configured in the API settings, or None when it is disabled """
+    if not response_cache_folder:
+        return None
+    return ResponseCache(response_cache_folder, response_cache_max_bytes, bypass=bypass_response_cache)
+
+#%% Telemetry
+
+def metrics_logger():
+    """ Logger writing one JSON line per request to metrics_file, rotated at metrics_max_bytes; None when disabled """
+    if not metrics_file:
+        return None
+    logger = logging.getLogger('step3_metrics')
+    if not logger.handlers:
+        handler = RotatingFileHandler(metrics_file, maxBytes=metrics_max_bytes, backupCount=metrics_backup_count, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+class Telemetry:
+    """
+    Per-request metrics (queue wait, latency, status, tokens, bytes, validation) written to the metrics
+    file, and per-round counters for the live summary: frames/min, tokens/min, error rate and ETA
+    """
+    def __init__(self):
+        self.logger = metrics_logger()
+        self.rounds = {}
+
+    def round_counters(self, round_number):
+        if round_number not in self.rounds:
+            self.rounds[round_number] = {"start": time.time(), "frames_total": 0, "frames_done": 0,
+                                         "requests": 0, "errors": 0, "tokens": 0}
+        return self.rounds[round_number]
+
+    def frames_queued(self, round_number, count):
+        self.round_counters(round_number)["frames_total"] += count
+
+    def frame_done(self, round_number):
+        self.round_counters(round_number)["frames_done"] += 1
+
+    def log_request(self, record):
+        counters = self.round_counters(record["round"])
+        counters["requests"] += 1
+        if record["outcome"] != "ok" or record.get("validation", "Valid") != "Valid":
+            counters["errors"] += 1
+        counters["tokens"] += (record.get("prompt_tokens") or 0) + (record.get("completion_tokens") or 0)
+        if self.logger is not None:
+            self.logger.info(json.dumps({"time": round(time.time(), 3), **record}, ensure_ascii=False))
+
+    def print_summary(self):
+        for round_number, counters in sorted(self.rounds.items()):
+            minutes = max(time.time() - counters["start"], 1e-9) / 60
+            frames_per_minute = counters["frames_done"] / minutes
+            remaining = counters["frames_total"] - counters["frames_done"]
+            eta = f"{remaining / frames_per_minute:.1f} min" if frames_per_minute > 0 else "?"
+            error_rate = counters["errors"] / counters["requests"] if counters["requests"] else 0.0
+            print(f"  📊 Round {round_number}: {counters['frames_done']}/{counters['frames_total']} frames, "
+                  f"{frames_per_minute:.1f} frames/min, {counters['tokens'] / minutes:.0f} tokens/min, "
+                  f"error rate {error_rate:.1%}, ETA {eta}")
+
+    async def report_every(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.print_summary()
+
+def usage_metrics(response_data):
+    """ Token counts from the usage block of a response """
+    usage = response_data.get("usage") or {}
+    return {
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "cached_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens"),
+        "completion_tokens": usage.get("completion_tokens")
+    }
+
+#%% Request engine
+
+def api_headers():
+    return {
+        'Authorization': f'Bearer {api_key}',
+        'Content-Type': 'application/json'
+    }
+
+class ConnectionPool:
+    """
+    Thread-safe pool of keep-alive connections to the API host. Each connection pays the
+    TCP/TLS handshake once; a connection the server closed while idle is replaced automatically.
+    """
+    def __init__(self, url, timeout=None):
+        url = urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.host = url.hostname
+        self.port = url.port
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.connections_opened = 0
+
+    def get(self):
+        """ Returns (connection, reused) """
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+            self.connections_opened += 1
+        return self.connection_class(self.host, self.port, timeout=self.timeout), False
+
+    def put(self, conn):
+        with self.lock:
+            self.idle.append(conn)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    def request(self, method, path, body, headers):
+        """
+        Send one request. Returns (status, reason, lower-case headers, body bytes, timing) where
+        timing has the seconds spent connecting (0 on a reused connection) and waiting for the response.
+        """
+        while True:
+            conn, reused = self.get()
+            connect_time = 0.0
+            try:
+                if conn.sock is None:
+                    connect_start = time.perf_counter()
+                    conn.connect()
+                    connect_time = time.perf_counter() - connect_start
+                response_start = time.perf_counter()
+                conn.request(method, path, body, headers)
+                res = conn.getresponse()
+                data = res.read()
+                response_time = time.perf_counter() - response_start
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused:
+                    continue  # Server closed the idle connection; retry on another or a new one
+                raise
+            except Exception:
+                conn.close()
+                raise
+            
+            if res.will_close:
+                conn.close()
+            else:
+                self.put(conn)
+            timing = {"connect": connect_time, "response": response_time, "reused": reused}
+            return res.status, res.reason, {key.lower(): value for key, value in res.getheaders()}, data, timing
+
+def send_request(pool, payload):
+    """ POST one chat-completion request. Returns (status, reason, lower-case headers, body text, timing) """
+    status, reason, headers, data, timing = pool.request("POST", urlsplit(api_url).path, payload, api_headers())
+    return status, reason, headers, data.decode("utf-8"), timing
+
+def retry_backoff(attempt):
+    """ Seconds to wait before retrying after an error or invalid response """
+    return min(2 ** attempt, 30)
+
+class RatingEngine:
+    """
+    Shared state of one rating run: concurrency limit, rate limiter, keep-alive connection pool
+    and the thread pool for blocking I/O
+    """
+    def __init__(self, max_in_flight):
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.scheduled = asyncio.Semaphore(2 * max_in_flight)  # Frames queued ahead of the in-flight ones
+        self.limiter = RateLimiter()
+        self.cache = open_response_cache()
+        self.pool = ConnectionPool(api_url, timeout=request_timeout)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight + 1)
+        self.latency = {"requests": 0, "connect": 0.0, "response": 0.0}
+        self.telemetry = Telemetry()
+
+    async def run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def record_latency(self, timing):
+        self.latency["requests"] += 1
+        self.latency["connect"] += timing["connect"]
+        self.latency["response"] += timing["response"]
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.pool.close()
+
+    def print_latency_summary(self):
+        requests = self.latency["requests"]
+        if requests:
+            print(f"Requests: {requests}, connections opened: {self.pool.connections_opened}, "
+                  f"mean connect time: {self.latency['connect'] / requests:.3f} sec., "
+                  f"mean response time: {self.latency['response'] / requests:.2f} sec.")
+
+async def post_with_retries(engine, label, payload, attempt=0, metrics=None):
+    """
+    POST one chat-completion request until a JSON response without an API error arrives. Errors use up
+    attempts, counting on from attempt; rate-limit waits do not. Failed requests are logged to the
+    telemetry with the fields of metrics (round, video, frames, kind).
+    Returns (response data or None, timing, attempt, metrics record of the successful request)
+    """
+    rate_limit_waits = 0
+    bytes_sent = len(payload.encode('utf-8'))
+    retries = 0
+    while attempt < max_attempts:
+        queued_at = time.time()
+        record = {**(metrics or {}), "retry": retries, "bytes_sent": bytes_sent}
+        retries += 1
+        async with engine.in_flight:
+            await engine.limiter.acquire()
+            record["queue_wait"] = round(time.time() - queued_at, 3)
+            try:
+                status, reason, headers, decoded_data, timing = await engine.run_blocking(send_request, engine.pool, payload)
+            except Exception as e:
+                attempt += 1
+                engine.telemetry.log_request({**record, "outcome": "exception", "error": f"{type(e).__name__}: {e}"})
+                print(f"    ⚠️ {label}: Unexpected error (attempt {attempt}/{max_attempts}): {type(e).__name__}: {e}")
+                await asyncio.sleep(retry_backoff(attempt))
+                continue
+        engine.limiter.update_from_headers(headers)
+        engine.record_latency(timing)
+        record.update({"status": status, "connect": round(timing["connect"], 3), "response": round(timing["response"], 3),
+                       "reused_connection": timing["reused"]})
+        
+        # Check if response is empty
+        if not decoded_data or len(decoded_data.strip()) == 0:
+            engine.telemetry.log_request({**record, "outcome": "empty"})
+            attempt += 1
+            print(f"    ⚠️ {label}: Empty response, HTTP {status} {reason} (attempt {attempt}/{max_attempts})")
+            await asyncio.sleep(retry_backoff(attempt))
+            continue
+        
+        # Try to parse JSON
+        try:
+            response_data = json.loads(decoded_data)
+        except json.JSONDecodeError as json_err:
+            engine.telemetry.log_request({**record, "outcome": "parse_error"})
+            attempt += 1
+            print(f"    ⚠️ {label}: JSON Parse Error, HTTP {status} (attempt {attempt}/{max_attempts}): {json_err}")
+            print(f"    Response content (first 300 chars): {decoded_data[:300]}")
+            await asyncio.sleep(retry_backoff(attempt))
+            continue
+        
+        # Check if API returned an error (non-200 status or error in the JSON)
+        if status != 200 or "error" in response_data:
+            error = response_data.get("error") if isinstance(response_data.get("error"), dict) else {}
+            error_message = error.get("message", decoded_data[:500])
+            
+            # Rate limits pause every request and do not use up an attempt
+            is_rate_limit = (status == 429 and error.get("code") != "insufficient_quota") \
+                or error.get("type") == "tokens" or "rate_limit" in error_message.lower()
+            engine.telemetry.log_request({**record, "outcome": "rate_limited" if is_rate_limit else "api_error",
+                                          "error": error_message[:300]})
+            if is_rate_limit and rate_limit_waits < max_rate_limit_waits:
+                rate_limit_waits += 1
+                wait_time = parse_wait_time(error_message, headers)
+                engine.limiter.pause(wait_time)
+                print(f"    ⚠️ {label}: Rate limit hit, pausing requests for {wait_time:.1f} seconds: {error_message}")
+                continue
+            
+            attempt += 1
+            print(f"    ❌ {label}: API Error {status} (attempt {attempt}/{max_attempts}): {error_message}")
+            await asyncio.sleep(retry_backoff(attempt))
+            continue
+        
+        engine.limiter.observe_usage(response_data)
+        return response_data, timing, attempt, {**record, "outcome": "ok", **usage_metrics(response_data)}
+    
+    return None, None, attempt, None
+
+async def request_missing_features(engine, video, frame_result, ratings, round_number, attempt):
+    """
+    Ask again for only the features missing from a frame's incomplete "Feature: Number" answer, using up
+    the remaining attempts, and merge the answers. The merged content lists the ratings in FEATURES order
+    and feature_sources records which request every feature came from. Returns the merged frame result
+    """
+    frame = next(frame for frame in video["frames"] if frame["frame_filename"] == frame_result["frame_filename"])
+    label = f"{video['subfolder']} (round {round_number}) frame {frame['frame_number']}/{len(video['frames'])}"
+    feature_sources = {"initial": list(ratings)}
+    
+    while attempt < max_attempts:
+        missing = [feature for feature in FEATURES if feature not in ratings]
+        print(f"    ↻ {label}: requesting the {len(missing)} missing features")
+        payload = json.dumps(build_request_body(video, [frame], features=missing))
+        metrics = {"round": round_number, "video": video["subfolder"], "frames": [frame["frame_number"]], "kind": "missing_features"}
+        response_data, timing, attempt, record = await post_with_retries(engine, f"{label} (missing features)", payload, attempt, metrics)
+        if response_data is None:
+            break
+        attempt += 1
+        
+        try:
+            choice = response_data["choices"][0]
+            answer = parse_feature_lines(choice["message"]["content"] or '', truncated=choice.get("finish_reason") == "length")
+        except (KeyError, IndexError, TypeError):
+            answer = {}
+        new_ratings = {feature: rating for feature, rating in answer.items() if feature in missing}
+        engine.telemetry.log_request({**record, "validation": f"{len(new_ratings)}/{len(missing)} missing features answered"
+                                      if len(new_ratings) < len(missing) else "Valid"})
+        ratings.update(new_ratings)
+        feature_sources[f"followup_{len(feature_sources)}"] = list(new_ratings)
+        if len(ratings) == len(FEATURES):
+            break
+    
+    # The merged answer replaces the content of the first response, so step4 reads it like any other
+    response = frame_result["response"]
+    merged_content = '\n'.join(f"{feature}: {ratings[feature]}" for feature in FEATURES if feature in ratings)
+    merged_choice = {**response["choices"][0], "message": {**response["choices"][0]["message"], "content": merged_content},
+                     "finish_reason": "stop"}
+    merged_result = {
+        "frame_number": frame_result["frame_number"],
+        "frame_filename": frame_result["frame_filename"],
+        "response": {**response, "choices": [merged_choice]},
+        "feature_sources": feature_sources
+    }
+    is_valid, feature_count, validation_msg = validate_response(merged_result["response"], expected_feature_count=len(FEATURES))
+    if is_valid:
+        print(f"    ✓ {label} completed with the missing features ({len(feature_sources) - 1} follow-up requests)")
+    else:
+        merged_result["validation_error"] = validation_msg
+        print(f"    ❌ {label}: {validation_msg} after {max_attempts} attempts")
+    return merged_result
+
+def failure_result(frame, error_message):
+    """
+    Frame result of a frame that got no usable response. It is journaled like any other result,
+    so step4 writes an all-missing row for it and lists it in the reprocessing manifest
+    """
+    return {
+        "frame_number": frame["frame_number"],
+        "frame_filename": frame["frame_filename"],
+        "response": {"error": {"message": error_message}},
+        "validation_error": error_message
+    }
+
+async def rate_frames(engine, video, frames, round_number):
+    """
+    Rate one frame, or several consecutive frames packed into one request, with retries. Frames of a
+    pack whose block is incomplete are requested again without the valid ones. When part of the
+    "Feature: Number" lines came back, only the missing features are requested again.
+    Returns {frame_filename: frame result stored in the JSON output}; frames without any response get a failure_result
+    """
+    results = {}
+    pending = frames
+    attempt = 0
+    while pending and attempt < max_attempts:
+        if len(pending) == 1:
+            label = f"{video['subfolder']} (round {round_number}) frame {pending[0]['frame_number']}/{len(video['frames'])}"
+        else:
+            label = (f"{video['subfolder']} (round {round_number}) "
+                     f"frames {pending[0]['frame_number']}-{pending[-1]['frame_number']}/{len(video['frames'])}")
+        payload = await engine.run_blocking(build_payload, video, pending)
+        
+        # Replay an identical earlier request of this round from the response cache
+        data_to_save = None
+        if engine.cache is not None:
+            cache_key = ResponseCache.key(payload, round_number, extra_round)
+            data_to_save = await engine.run_blocking(engine.cache.get, cache_key)
+            if data_to_save is not None:
+                print(f"    ✓ {label} taken from the response cache")
+        from_cache = data_to_save is not None
+        
+        record = None
+        if data_to_save is None:
+            metrics = {"round": round_number, "video": video["subfolder"],
+                       "frames": [frame["frame_number"] for frame in pending], "kind": "rating"}
+            data_to_save, timing, attempt, record = await post_with_retries(engine, label, payload, attempt, metrics)
+            if data_to_save is None:
+                break
+        
+        # Validate the response (every frame's block of a packed one) before accepting it
+        invalid = []
+        for frame in pending:
+            pack = pack_label(frame) if len(pending) > 1 else None
+            is_valid, feature_count, validation_msg = validate_response(data_to_save, pack=pack)
+            frame_result = {
+                "frame_number": frame["frame_number"],
+                "frame_filename": frame["frame_filename"],
+                "response": data_to_save
+            }
+            if pack is not None:
+                frame_result["pack"] = pack  # step4 reads only this frame's block
+            if is_valid:
+                results[frame["frame_filename"]] = frame_result
+            else:
+                frame_result["validation_error"] = validation_msg
+                invalid.append(frame_result)
+        if record is not None:
+            engine.telemetry.log_request({**record, "validation": invalid[0]["validation_error"] if invalid else "Valid",
+                                          "invalid_frames": len(invalid)})
+        
+        if not invalid:
+            if not from_cache:
+                print(f"    ✓ {label} analyzed successfully ({feature_count} features{' per frame' if len(pending) > 1 else ''}, {timing['response']:.1f} sec.)")
+                if engine.cache is not None:
+                    await engine.run_blocking(engine.cache.put, cache_key, data_to_save)
+            break
+        
+        # Response incomplete - retry the frames without a valid block
+        attempt += 1
+        print(f"    ⚠️ {label}: {invalid[0]['validation_error']} "
+              f"({len(invalid)}/{len(pending)} frames incomplete, attempt {attempt}/{max_attempts})")
+        
+        # Frames that got part of their "Feature: Number" lines only ask for the missing features
+        partial = []
+        if output_format == 'lines' and attempt < max_attempts:
+            for frame_result in invalid:
+                choice = data_to_save["choices"][0]
+                content = choice["message"]["content"] or ''
+                if "pack" in frame_result:
+                    content = split_pack_blocks(content).get(frame_result["pack"], '')
+                ratings = parse_feature_lines(content, truncated=choice.get("finish_reason") == "length")
+                if ratings:
+                    partial.append(request_missing_features(engine, video, frame_result, ratings, round_number, attempt))
+        for merged_result in await asyncio.gather(*partial):
+            results[merged_result["frame_filename"]] = merged_result
+        
+        if attempt < max_attempts:
+            pending = [frame for frame in pending if frame["frame_filename"] not in results]
+            if pending:
+                await asyncio.sleep(retry_backoff(attempt))
+            continue
+        
+        print(f"    ❌ {label}: Failed validation after {max_attempts} attempts")
+        # Still store the incomplete responses for debugging
+        for frame_result in invalid:
+            results[frame_result["frame_filename"]] = frame_result
+        break
+    
+    for frame in frames:
+        if frame["frame_filename"] not in results:
+            print(f"    ❌ Failed to process {video['subfolder']} (round {round_number}) frame {frame['frame_number']} after {max_attempts} attempts.")
+            results[frame["frame_filename"]] = failure_result(frame, f"No response after {max_attempts} attempts")
+    return results
+
+async def rate_frame(engine, video, frame, frame_tasks, round_number, pack_task=None):
+    """ Rate one frame, or take its result from the packed request it is part of. Returns the frame result, or None """
+    # Copy the ratings of the run representative instead of calling the API again
+    representative = video["duplicate_of"].get(frame["frame_filename"])
+    if representative in frame_tasks:
+        representative_result = await frame_tasks[representative]
+        if representative_result is not None and "validation_error" not in representative_result:
+            print(f"    ✓ {video['subfolder']} (round {round_number}) frame {frame['frame_number']}/{len(video['frames'])} "
+                  f"is a near-duplicate of {representative}, ratings copied")
+            return {
+                **representative_result,
+                "frame_number": frame["frame_number"],
+                "frame_filename": frame["frame_filename"],
+                "propagated_from": representative
+            }
+    
+    if pack_task is not None:
+        return (await pack_task).get(frame["frame_filename"])
+    return (await rate_frames(engine, video, [frame], round_number)).get(frame["frame_filename"])
+
+class FrameJournal:
+    """
+    Append-only JSONL journal of frame results, one line per frame. Lines are flushed right away
+    and fsynced every fsync_every frames. Results already in the journal are loaded on open, so an
+    interrupted video resumes at the first frame that has no result yet.
+    """
+    def __init__(self, path, fsync_every=20):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.records = {}
+        self.unsynced = 0
+        needs_newline = False
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    needs_newline = not line.endswith('\n')
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Line cut off by a crash
+                    self.records[(record["subfolder"], record["frame_filename"])] = record
+        except FileNotFoundError:
+            pass
+        self.outfile = open(path, 'a', encoding='utf-8')
+        if needs_newline:
+            self.outfile.write('\n')
+
+    def get(self, subfolder, frame_filename):
+        return self.records.get((subfolder, frame_filename))
+
+    def append(self, subfolder, frame_result):
+        record = {"subfolder": subfolder, **frame_result}
+        self.outfile.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.outfile.flush()
+        self.records[(subfolder, frame_result["frame_filename"])] = record
+        self.unsynced += 1
+        if self.unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        if self.unsynced:
+            os.fsync(self.outfile.fileno())
+            self.unsynced = 0
+
+    def close(self):
+        self.sync()
+        self.outfile.close()
+
+def open_round(round_number, output_folder):
+    """ Output paths and progress of one round: processed videos, excluded transcripts, journal and counters """
     # Dynamically set the processed_file and exclusion_file based on round_number
     processed_file = f'output_{round_number}_{extra_round}.txt'
     exclusion_file = f'output_audio_{round_number}.txt'
@@ -83,255 +1193,505 @@ def process_media_files(folder_path, round_number, output_folder='./output_data'
         os.makedirs(output_folder)
     
     # Add output_folder path to processed_file and exclusion_file files
-    processed_file_path = os.path.join(output_folder, processed_file)
+    round_state = {
+        "round_number": round_number,
+        "processed_file_path": os.path.join(output_folder, processed_file),
+        "output_file_path": os.path.join(output_folder, f'output_{round_number}_{extra_round}.json'),
+        "journal": FrameJournal(os.path.join(output_folder, f'output_{round_number}_{extra_round}.jsonl'),
+                                journal_fsync_every),
+        "start_time": time.time(),
+        "processed_count": 0,
+        "reprocess_frames": load_reprocess_manifest(round_number)
+    }
     exclusion_file_path = os.path.join(output_folder, exclusion_file)
     
-    # Load previous processed images    
+    # Load previous processed videos
     try:
-        with open(processed_file_path, 'r') as f:
-            processed_files = [line.strip() for line in f]
+        with open(round_state["processed_file_path"], 'r') as f:
+            round_state["processed_files"] = {line.strip() for line in f}
     except FileNotFoundError:
-        processed_files = []
+        round_state["processed_files"] = set()
         
     try:
         with open(exclusion_file_path, 'r', encoding='utf-8') as file:
-            excluded_files = set(file.read().splitlines())  # Use a set for faster lookup
+            round_state["excluded_files"] = set(file.read().splitlines())  # Use a set for faster lookup
+    except FileNotFoundError:
+        round_state["excluded_files"] = set()
+    
+    return round_state
+
+def load_reprocess_manifest(round_number):
+    """ {video: set of frame filenames} of the round's reprocessing manifest (written by step4), or None without one """
+    if not reprocess_manifest:
+        return None
+    manifest_path = reprocess_manifest.format(round_number=round_number)
+    reprocess_frames = {}
+    try:
+        with open(manifest_path, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                reprocess_frames.setdefault(row["video"], set()).add(row["frame_filename"])
     except FileNotFoundError:
-        excluded_files = set()
+        print(f"⚠️ No reprocessing manifest {manifest_path}, no frames to re-rate in round {round_number}")
+    return reprocess_frames
 
-    processed_count = 0  # Count of processed images in this run
+def round_video_inputs(folder_path, subfolder, round_state):
+    """ Inputs of one video in a round; with a reprocessing manifest only the listed frames are kept """
+    video = collect_video_inputs(subfolder, os.path.join(folder_path, subfolder), round_state["excluded_files"])
+    reprocess_frames = round_state["reprocess_frames"]
+    if reprocess_frames is not None:
+        listed = reprocess_frames.get(subfolder, set())
+        # Frame numbers stay those of the whole folder, so the new results line up with the earlier rounds
+        video["frames"] = [frame for frame in video["frames"] if frame["frame_filename"] in listed]
+        # A near-duplicate whose representative is not re-rated gets its own request
+        video["duplicate_of"] = {duplicate: representative for duplicate, representative in video["duplicate_of"].items()
+                                 if representative in listed}
+    return video
+
+def pending_videos(folder_path, round_state):
+    """ Yield the inputs of every video folder not yet processed in this round """
+    reprocess_frames = round_state["reprocess_frames"]
     
     # Iterate over all files in the subfolders
-    for subfolder in os.listdir(folder_path):
+    for subfolder in sorted(os.listdir(folder_path)):
         subfolder_path = os.path.join(folder_path, subfolder)
-        if os.path.isdir(subfolder_path) and subfolder not in processed_files:
-            
-            # Collect all PNG files and audio transcripts
-            image_files = []
-            audio_contents = []
-            
-            for filename in os.listdir(subfolder_path):
-                file_path = os.path.join(subfolder_path, filename)
-                
-                if filename.lower().endswith('.png'):
-                    image_files.append(file_path)
-                    
-                if filename.lower().endswith('.txt'):
-                    if filename not in excluded_files:
-                        with open(file_path, 'r', encoding='utf-8') as text_file:
-                            transcription_text = text_file.read()
-                        audio_contents.append({
-                            "type": "text",
-                            "text": transcription_text
-                        })
-            
-            # Sort image files to maintain temporal order
-            image_files.sort()
-            
-            if image_files:  # Only proceed if there are images to analyze
-                
-                print(f"\n=== Processing {subfolder} ===")
-                print(f"Total frames to analyze: {len(image_files)}")
-                print(f"Audio transcripts: {len(audio_contents)}")
-                
-                # Store all frame results for this video
-                video_results = {
-                    "subfolder": subfolder,
-                    "frames": []
-                }
-                
-                # Process each frame separately
-                for frame_idx, image_path in enumerate(image_files):
-                    frame_number = frame_idx + 1
-                    print(f"\n  → Analyzing frame {frame_number}/{len(image_files)}: {os.path.basename(image_path)}")
-                    
-                    # Encode the current frame
-                    base64_image = encode_image(image_path)
-                    image_content = {
-                        "type": "image_url",
-                        "image_url": {"url": base64_image}
-                    }
-                    
-                    # Setup the connection and headers for the API request
-                    headers = {
-                        'Authorization': '',  # ← REPLACE WITH YOUR ACTUAL KEY
-                        'Content-Type': 'application/json'
-                    }
-                    
-                    # Build payload with single frame + audio transcripts
-                    payload = json.dumps({
-                        "model": "gpt-4.1",  # Valid model that supports vision
-                        "messages": [
-                            {
-                                "role": "user",
-                                "content": [
-                                    {
-                                        "type": "text",
-                                        "text": prompt
-                                    },
-                                    image_content,
-                                    *audio_contents
-                                ]
-                            }
-                        ],
-                        "max_tokens": 8192  # FIXED: Increased from 4096 to ensure full responses
-                    })
-                    
-                    # Attempt to send the request with retries
-                    for attempt in range(3):  # Retry up to 3 times
-                        try:
-                            # Create fresh connection for each attempt
-                            conn = http.client.HTTPSConnection("api.openai.com")
-                            conn.request("POST", "/v1/chat/completions", payload, headers)
-                            res = conn.getresponse()
-                            
-                            # Check status code FIRST
-                            print(f"    HTTP Status: {res.status} {res.reason}")
-                            
-                            # Read response
-                            data = res.read()
-                            decoded_data = data.decode("utf-8")
-                            
-                            # Check if response is empty
-                            if not decoded_data or len(decoded_data.strip()) == 0:
-                                print(f"    ⚠️ Empty response (attempt {attempt + 1}/3)")
-                                conn.close()
-                                time.sleep(5)
-                                continue
-                            
-                            # Check for non-200 status
-                            if res.status != 200:
-                                print(f"    ⚠️ API Error {res.status}: {decoded_data[:500]}")
-                                conn.close()
-                                time.sleep(5)
-                                continue
-                            
-                            # Try to parse JSON
-                            try:
-                                data_to_save = json.loads(decoded_data)
-                            except json.JSONDecodeError as json_err:
-                                print(f"    ⚠️ JSON Parse Error (attempt {attempt + 1}/3): {json_err}")
-                                print(f"    Response content (first 300 chars):")
-                                print(decoded_data[:300])
-                                conn.close()
-                                time.sleep(5)
-                                continue
-                            
-                            # Check if API returned an error in the JSON
-                            if "error" in data_to_save:
-                                error_message = data_to_save["error"].get("message", "Unknown error")
-                                error_type = data_to_save["error"].get("type", "")
-                                
-                                # Handle rate limit errors specially
-                                if error_type == "tokens" or "rate_limit" in error_message.lower():
-                                    print(f"    ⚠️ Rate limit hit: {error_message}")
-                                    # Extract wait time from message
-                                    wait_match = re.search(r'try again in ([\d.]+)s', error_message)
-                                    if wait_match:
-                                        wait_time = float(wait_match.group(1)) + 1  # Add 1 second buffer
-                                    else:
-                                        wait_time = 10  # Default wait
-                                    print(f"    Waiting {wait_time:.1f} seconds before retry...")
-                                    time.sleep(wait_time)
-                                    conn.close()
-                                    continue  # Retry the request
-                                
-                                print(f"    ❌ API Error: {error_message}")
-                                conn.close()
-                                if attempt < 2:  # If not last attempt
-                                    time.sleep(5)
-                                    continue
-                                else:
-                                    break  # Don't retry on other API errors after 3 attempts
-                            
-                            # FIXED: Validate the response before accepting it
-                            is_valid, feature_count, validation_msg = validate_response(data_to_save)
-                            
-                            if is_valid:
-                                # SUCCESS! Store frame result
+        if not os.path.isdir(subfolder_path) or subfolder in round_state["processed_files"]:
+            continue
+        if reprocess_frames is not None and subfolder not in reprocess_frames:
+            continue
+        
+        video = round_video_inputs(folder_path, subfolder, round_state)
+        if video["frames"]:  # Only proceed if there are images to analyze
+            yield video
+
+def save_video_results(video, frame_results, round_state):
+    """ Journal any results not journaled yet and mark the video as processed """
+    journal = round_state["journal"]
+    for frame_result in frame_results:
+        if journal.get(video["subfolder"], frame_result["frame_filename"]) is None:
+            journal.append(video["subfolder"], frame_result)
+    journal.sync()
+    
+    video_results = {
+        "subfolder": video["subfolder"],
+        "frames": sorted(frame_results, key=lambda frame: frame["frame_number"])
+    }
+    
+    print(f"\n  === Video Summary: {video['subfolder']} (round {round_state['round_number']}) ===")
+    print(f"  Total frames attempted: {len(video['frames'])}")
+    print(f"  Frames with responses: {len(video_results['frames'])}")
+    
+    # Check for incomplete responses
+    incomplete_frames = [frame["frame_number"] for frame in video_results["frames"] if "validation_error" in frame]
+    if incomplete_frames:
+        print(f"  ⚠️ Frames with incomplete data: {incomplete_frames}")
+    else:
+        print(f"  ✓ All frames have complete data")
+    
+    # Save all frame results for this video
+    if write_video_json:
+        with open(round_state["output_file_path"], 'a', encoding='utf-8') as outfile:
+            json.dump(video_results, outfile, ensure_ascii=False, indent=4)
+            outfile.write('\n')
+    
+    # Save progress
+    try:
+        with open(round_state["processed_file_path"], 'a') as f:
+            f.write(video["subfolder"] + '\n')
+    except Exception as e:
+        print(f"Error writing to {round_state['processed_file_path']}: {e}")
+    round_state["processed_files"].add(video["subfolder"])
+    
+    round_state["processed_count"] += 1
+    elapsed_time = time.time() - round_state["start_time"]
+    print(f"\n✓ Successfully processed {video['subfolder']} (round {round_state['round_number']}) with {len(video['frames'])} frames ({round_state['processed_count']} videos total), elapsed time: {elapsed_time:.2f} sec.")
+
+async def rate_and_journal_frame(engine, video, frame, frame_tasks, journal, round_number, pack_task=None):
+    """ Take the frame's result from the journal if it has one, otherwise rate it and journal the result """
+    record = journal.get(video["subfolder"], frame["frame_filename"])
+    if record is not None:
+        return {key: value for key, value in record.items() if key != "subfolder"}
+    frame_result = await rate_frame(engine, video, frame, frame_tasks, round_number, pack_task)
+    engine.telemetry.frame_done(round_number)
+    if frame_result is not None:
+        journal.append(video["subfolder"], frame_result)
+    return frame_result
+
+async def finish_video(video, frame_tasks, round_state):
+    """ Wait for all frames of a video, then save its results """
+    results = await asyncio.gather(*frame_tasks.values())
+    save_video_results(video, [result for result in results if result is not None], round_state)
+
+async def queue_video(engine, video, round_state):
+    """ Schedule the frame requests of one video of one round. Returns the task that saves its results """
+    round_number = round_state["round_number"]
+    journal = round_state["journal"]
+    print(f"\n=== Queueing {video['subfolder']} (round {round_number}) ===")
+    print(f"Total frames to analyze: {len(video['frames'])}")
+    print(f"Audio transcripts: {len(video['audio_contents'])}")
+    if video["frame_transcripts"]:
+        print(f"Per-frame transcript slices: {len(video['frame_transcripts'])}")
+    if video["duplicate_of"]:
+        print(f"Near-duplicate frames (ratings copied): {len(video['duplicate_of'])}")
+    resumed = sum(1 for frame in video["frames"] if journal.get(video["subfolder"], frame["frame_filename"]))
+    if resumed:
+        print(f"Frames already in the journal: {resumed}")
+    
+    # Packed requests are scheduled with their first frame; their frames only wait for the pack's results
+    pack_tasks = {}
+    first_of_pack = {pack[0]["frame_filename"]: pack for pack in frame_packs(video, journal) if len(pack) > 1}
+    
+    # Frames are scheduled in order, so a representative always starts before its duplicates
+    frame_tasks = {}
+    for frame in video["frames"]:
+        if frame["frame_filename"] in first_of_pack:
+            pack = first_of_pack[frame["frame_filename"]]
+            await engine.scheduled.acquire()
+            pack_task = asyncio.create_task(rate_frames(engine, video, pack, round_number))
+            pack_task.add_done_callback(lambda _: engine.scheduled.release())
+            pack_tasks.update({packed_frame["frame_filename"]: pack_task for packed_frame in pack})
+        pack_task = pack_tasks.get(frame["frame_filename"])
+        if pack_task is None:
+            await engine.scheduled.acquire()
+        task = asyncio.create_task(rate_and_journal_frame(engine, video, frame, frame_tasks, journal, round_number, pack_task))
+        if pack_task is None:
+            task.add_done_callback(lambda _: engine.scheduled.release())
+        frame_tasks[frame["frame_filename"]] = task
+    
+    return asyncio.create_task(finish_video(video, frame_tasks, round_state))
+
+def interleave_rounds(round_videos):
+    """ Yield (round_state, video) from [(round_state, videos)] for all rounds, taking one video of each round in turn """
+    round_videos = [(round_state, iter(videos)) for round_state, videos in round_videos]
+    while round_videos:
+        for round_state, videos in list(round_videos):
+            video = next(videos, None)
+            if video is None:
+                round_videos.remove((round_state, videos))
+            else:
+                yield round_state, video
+
+async def rate_rounds(folder_path, rounds):
+    """
+    Rate every unprocessed (round, video, frame) of several rounds under one engine, so all rounds share
+    the max_in_flight limit and the rate limiter. rounds is a list of (round_number, output_folder);
+    each round keeps its own journal and progress file.
+    """
+    round_states = [open_round(round_number, output_folder) for round_number, output_folder in rounds]
+    engine = RatingEngine(max_in_flight)
+    
+    # Frames still to rate per round, for the ETA of the live summary
+    round_videos = [(round_state, list(pending_videos(folder_path, round_state))) for round_state in round_states]
+    for round_state, videos in round_videos:
+        journal = round_state["journal"]
+        engine.telemetry.frames_queued(round_state["round_number"], sum(
+            1 for video in videos for frame in video["frames"] if journal.get(video["subfolder"], frame["frame_filename"]) is None))
+    
+    video_tasks = []
+    report_task = asyncio.create_task(engine.telemetry.report_every(progress_interval))
+    try:
+        for round_state, video in interleave_rounds(round_videos):
+            video_tasks.append(await queue_video(engine, video, round_state))
+        
+        await asyncio.gather(*video_tasks)
+    finally:
+        report_task.cancel()
+        engine.close()
+        for round_state in round_states:
+            round_state["journal"].close()
+    
+    engine.telemetry.print_summary()
+    
+    for round_state in round_states:
+        total_time = time.time() - round_state["start_time"]
+        print(f"\nRound {round_state['round_number']}: processed {round_state['processed_count']} videos, "
+              f"total elapsed time: {total_time:.2f} sec.")
+    engine.print_latency_summary()
+    if engine.cache is not None:
+        engine.cache.print_summary()
+
+async def rate_round(folder_path, round_number, output_folder):
+    """ Rate every unprocessed video of a round, keeping up to max_in_flight frame requests in flight """
+    await rate_rounds(folder_path, [(round_number, output_folder)])
+
+def run_async(coroutine):
+    """ asyncio.run that also works from IPython/Spyder consoles, which already run an event loop """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as runner:
+        return runner.submit(asyncio.run, coroutine).result()
+
+# Process all images in a folder and save responses to a JSON file
+def process_media_files(folder_path, round_number, output_folder='./output_data'):
+    run_async(rate_round(folder_path, round_number, output_folder))
+
+#%% Batch API mode
+
+def api_call(method, endpoint, body=None, content_type='application/json', raw=False):
+    """ One request to another API endpoint next to chat completions (e.g. '/files', '/batches') """
+    base_path = urlsplit(api_url).path.rsplit('/chat/completions', 1)[0]
+    headers = api_headers()
+    headers['Content-Type'] = content_type
+    pool = ConnectionPool(api_url, timeout=request_timeout)
+    try:
+        status, reason, _, data, _ = pool.request(method, base_path + endpoint, body, headers)
+    finally:
+        pool.close()
+    if status >= 400:
+        raise RuntimeError(f"{method} {endpoint} failed with HTTP {status} {reason}: {data[:500].decode('utf-8', 'replace')}")
+    return data.decode('utf-8') if raw else json.loads(data)
+
+def batch_submit(jsonl_path):
+    """ Upload a JSONL request file and create a batch for it. Returns the batch id """
+    boundary = uuid.uuid4().hex
+    with open(jsonl_path, 'rb') as f:
+        file_content = f.read()
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="purpose"\r\n\r\nbatch\r\n'
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{os.path.basename(jsonl_path)}"\r\n'
+            f'Content-Type: application/jsonl\r\n\r\n').encode('utf-8') + file_content + f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    uploaded_file = api_call("POST", "/files", body, f'multipart/form-data; boundary={boundary}')
+    batch = api_call("POST", "/batches", json.dumps({
+        "input_file_id": uploaded_file["id"],
+        "endpoint": "/v1/chat/completions",
+        "completion_window": "24h"
+    }))
+    return batch["id"]
+
+def batch_poll(batch_id):
+    """ Current state of a batch (status, request_counts, output_file_id, error_file_id, ...) """
+    return api_call("GET", f"/batches/{batch_id}")
+
+def batch_download(file_id):
+    """ Content of a batch output or error file (JSONL text) """
+    return api_call("GET", f"/files/{file_id}/content", raw=True)
+
+class BatchFileWriter:
+    """ Write request lines into JSONL files, starting a new file before a batch limit is reached """
+    def __init__(self, batch_folder, run_id):
+        self.batch_folder = batch_folder
+        self.run_id = run_id
+        self.files = []  # (path, (round, video) keys, [round, video, frame_filename] of the requested frames)
+        self.outfile = None
+
+    def add(self, line, key, frame_filenames):
+        data = (json.dumps(line, ensure_ascii=False) + '\n').encode('utf-8')
+        if self.outfile is None or self.count >= batch_max_requests or self.size + len(data) > batch_max_bytes:
+            self.close()
+            path = os.path.join(self.batch_folder, f'requests_{self.run_id}_{len(self.files) + 1}.jsonl')
+            self.outfile = open(path, 'wb')
+            self.files.append((path, set(), []))
+            self.count = self.size = 0
+        self.outfile.write(data)
+        self.count += 1
+        self.size += len(data)
+        self.files[-1][1].add(key)
+        self.files[-1][2].extend([*key, frame_filename] for frame_filename in frame_filenames)
+
+    def close(self):
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+
+def batch_frame_result(frame, line, cache=None):
+    """ Frame result (same layout as the realtime engine) from one line of a batch output file, or None """
+    response = line.get("response") or {}
+    data_to_save = response.get("body")
+    if line.get("error") or response.get("status_code") != 200 or not isinstance(data_to_save, dict):
+        print(f"    ❌ {frame['frame_filename']}: {line.get('error') or (data_to_save or {}).get('error')}")
+        return None
+    round_number, subfolder, frame_filenames, cache_key = json.loads(line["custom_id"])
+    pack = pack_label(frame) if len(frame_filenames) > 1 else None
+    frame_result = {
+        "frame_number": frame["frame_number"],
+        "frame_filename": frame["frame_filename"],
+        "response": data_to_save
+    }
+    if pack is not None:
+        frame_result["pack"] = pack
+    is_valid, feature_count, validation_msg = validate_response(data_to_save, pack=pack)
+    if not is_valid:
+        frame_result["validation_error"] = validation_msg
+    elif cache is not None and frame["frame_filename"] == frame_filenames[0]:
+        # A packed response is only cached when the blocks of all of its frames are valid
+        blocks = split_pack_blocks(data_to_save["choices"][0]["message"]["content"]) if pack is not None else {}
+        if pack is None or (len(blocks) == len(frame_filenames)
+                            and all(validate_response(data_to_save, pack=label)[0] for label in blocks)):
+            cache.put(cache_key, data_to_save)
+    return frame_result
+
+def batch_video_results(video, video_lines, journal, cache=None, final_frames=()):
+    """
+    Frame results of one video from the journal, the batch output lines and near-duplicate copies.
+    A near-duplicate is only copied from a valid result. A frame whose batch line is missing, failed
+    or incomplete only keeps it (or a failure_result) once it is in final_frames, the frames that
+    had max_attempts attempts. Until then the results are journaled and None is returned, so the
+    video stays pending and a follow-up batch requests only the frames without a result.
+    """
+    frame_results = {}
+    unrated_frames = []
+    for frame in video["frames"]:
+        representative = video["duplicate_of"].get(frame["frame_filename"])
+        record = journal.get(video["subfolder"], frame["frame_filename"])
+        if record is not None:
+            frame_results[frame["frame_filename"]] = {key: value for key, value in record.items() if key != "subfolder"}
+        elif representative in frame_results and "validation_error" not in frame_results[representative]:
+            frame_results[frame["frame_filename"]] = {
+                **frame_results[representative],
+                "frame_number": frame["frame_number"],
+                "frame_filename": frame["frame_filename"],
+                "propagated_from": representative
+            }
+        else:
+            line = video_lines.get(frame["frame_filename"])
+            frame_result = batch_frame_result(frame, line, cache) if line is not None else None
+            if frame_result is not None and ("validation_error" not in frame_result or frame["frame_filename"] in final_frames):
+                frame_results[frame["frame_filename"]] = frame_result
+            elif frame["frame_filename"] in final_frames:
+                frame_results[frame["frame_filename"]] = failure_result(frame, f"No batch result after {max_attempts} attempts")
+            else:
+                unrated_frames.append(frame["frame_number"])
+    
+    if unrated_frames:
+        for frame_result in frame_results.values():
+            if journal.get(video["subfolder"], frame_result["frame_filename"]) is None:
+                journal.append(video["subfolder"], frame_result)
+        journal.sync()
+        print(f"  ⚠️ {video['subfolder']}: frames {unrated_frames} have no valid result yet, left pending for a follow-up batch")
+        return None
+    return list(frame_results.values())
+
+def process_rounds_batch(folder_path, rounds, batch_folder, submit=batch_submit, poll=batch_poll, download=batch_download):
+    """
+    Rate all pending (round, video, frame) requests through the Batch API. rounds is a list of
+    (round_number, output_folder). The results go to the same journal and progress files as with
+    the realtime engine. Frames whose answer is missing, failed or incomplete are requested again
+    in follow-up batches until they had max_attempts attempts. Submitted batches and attempts are
+    kept in a state file, so an interrupted run polls them again instead of resubmitting. submit,
+    poll and download can be replaced by a local stand-in for testing.
+    """
+    os.makedirs(batch_folder, exist_ok=True)
+    state_path = os.path.join(batch_folder, f'batch_state_{extra_round}.json')
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        state = {"batches": []}
+    attempts = state.setdefault("attempts", {})  # json.dumps([round, video, frame_filename]) -> finished batch attempts
+    
+    def save_state():
+        with open(state_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=4)
+    
+    round_states = {round_number: open_round(round_number, output_folder) for round_number, output_folder in rounds}
+    cache = open_response_cache()
+    
+    while True:
+        waiting = {tuple(key) for batch in state["batches"] if not batch["converted"] for key in batch["videos"]}
+        
+        # Write every pending request (one per pack of frames) into JSONL files; near-duplicates are copied later instead
+        writer = BatchFileWriter(batch_folder, len(state["batches"]) + 1)
+        try:
+            for round_number, round_state in round_states.items():
+                for video in pending_videos(folder_path, round_state):
+                    if (round_number, video["subfolder"]) in waiting:
+                        continue
+                    requests_added = 0
+                    for pack in frame_packs(video, round_state["journal"]):
+                        request_body = build_request_body(video, pack)
+                        cache_key = ResponseCache.key(json.dumps(request_body), round_number, extra_round)
+                        cached_response = cache.get(cache_key) if cache is not None else None
+                        if cached_response is not None:
+                            for frame in pack:
                                 frame_result = {
-                                    "frame_number": frame_number,
-                                    "frame_filename": os.path.basename(image_path),
-                                    "response": data_to_save
+                                    "frame_number": frame["frame_number"],
+                                    "frame_filename": frame["frame_filename"],
+                                    "response": cached_response
                                 }
-                                video_results["frames"].append(frame_result)
-                                print(f"    ✓ Frame {frame_number} analyzed successfully ({feature_count} features)")
-                                conn.close()
-                                
-                                # Add delay to avoid rate limits (wait between frames)
-                                if frame_number < len(image_files):  # Don't wait after last frame
-                                    print(f"    Waiting 2 seconds before next frame...")
-                                    time.sleep(2)
-                                
-                                break  # Exit retry loop
-                            else:
-                                # Response incomplete - retry
-                                print(f"    ⚠️ {validation_msg}")
-                                conn.close()
-                                if attempt < 2:  # If not last attempt
-                                    print(f"    Retrying...")
-                                    time.sleep(5)
-                                    continue
-                                else:
-                                    print(f"    ❌ Failed validation after 3 attempts")
-                                    # Still store the incomplete response for debugging
-                                    frame_result = {
-                                        "frame_number": frame_number,
-                                        "frame_filename": os.path.basename(image_path),
-                                        "response": data_to_save,
-                                        "validation_error": validation_msg
-                                    }
-                                    video_results["frames"].append(frame_result)
-                                    break
-                            
-                        except Exception as e:
-                            print(f"    ⚠️ Unexpected error (attempt {attempt + 1}/3): {type(e).__name__}: {e}")
-                            try:
-                                conn.close()
-                            except:
-                                pass
-                            time.sleep(5)
-                    else:
-                        print(f"    ❌ Failed to process frame {frame_number} after 3 attempts.")
-                
-                # FIXED: Add summary statistics
-                print(f"\n  === Video Summary ===")
-                print(f"  Total frames attempted: {len(image_files)}")
-                print(f"  Frames with responses: {len(video_results['frames'])}")
-                
-                # Check for incomplete responses
-                incomplete_frames = []
-                for frame in video_results["frames"]:
-                    if "validation_error" in frame:
-                        incomplete_frames.append(frame["frame_number"])
-                
-                if incomplete_frames:
-                    print(f"  ⚠️ Frames with incomplete data: {incomplete_frames}")
-                else:
-                    print(f"  ✓ All frames have complete data")
-                
-                # Save all frame results for this video
-                output_file_path = os.path.join(output_folder, f'output_{round_number}_{extra_round}.json')
-                with open(output_file_path, 'a', encoding='utf-8') as outfile:
-                    json.dump(video_results, outfile, ensure_ascii=False, indent=4)
-                    outfile.write('\n')
-
-                # Save progress
-                try:
-                    with open(processed_file_path, 'a') as f:
-                        f.write(subfolder + '\n')
-                except Exception as e:
-                    print(f"Error writing to {processed_file_path}: {e}")
-                
-                processed_count += 1
-                
-                # Print progress after every video
-                elapsed_time = time.time() - start_time
-                print(f"\n✓ Successfully processed {subfolder} with {len(image_files)} frames ({processed_count} videos total), elapsed time: {elapsed_time:.2f} sec.")
-                    
-    total_time = time.time() - start_time
-    print(f"\nProcessed {processed_count} videos, total elapsed time: {total_time:.2f} sec.")
+                                if len(pack) > 1:
+                                    frame_result["pack"] = pack_label(frame)
+                                round_state["journal"].append(video["subfolder"], frame_result)
+                            continue
+                        requests_added += 1
+                        frame_filenames = [frame["frame_filename"] for frame in pack]
+                        writer.add({
+                            "custom_id": json.dumps([round_number, video["subfolder"], frame_filenames, cache_key]),
+                            "method": "POST",
+                            "url": "/v1/chat/completions",
+                            "body": request_body
+                        }, (round_number, video["subfolder"]), frame_filenames)
+                    if not requests_added:
+                        # Every frame is already in the journal or the response cache (e.g. the run stopped before marking the video done)
+                        frame_results = batch_video_results(video, {}, round_state["journal"])
+                        if frame_results is not None:
+                            save_video_results(video, frame_results, round_state)
+        finally:
+            writer.close()
+        
+        for path, keys, frames in writer.files:
+            batch_id = submit(path)
+            state["batches"].append({"id": batch_id, "file": path, "videos": sorted(keys), "frames": frames, "converted": False})
+            save_state()
+            print(f"✓ Submitted {os.path.basename(path)} as batch {batch_id} ({len(keys)} videos)")
+        
+        # Poll until every open batch has finished
+        open_batches = [batch for batch in state["batches"] if not batch["converted"]]
+        if not open_batches:
+            break
+        finished = {}
+        while len(finished) < len(open_batches):
+            for batch in open_batches:
+                if batch["id"] in finished:
+                    continue
+                batch_info = poll(batch["id"])
+                counts = batch_info.get("request_counts", {})
+                print(f"  Batch {batch['id']}: {batch_info['status']} "
+                      f"({counts.get('completed', 0)}/{counts.get('total', '?')} done, {counts.get('failed', 0)} failed)")
+                if batch_info["status"] in ('completed', 'failed', 'expired', 'cancelled'):
+                    finished[batch["id"]] = batch_info
+            if len(finished) < len(open_batches):
+                time.sleep(batch_poll_interval)
+        
+        # Collect the output lines per (round, video)
+        results = {}
+        for batch_info in finished.values():
+            for file_key in ('output_file_id', 'error_file_id'):
+                if not batch_info.get(file_key):
+                    continue
+                for raw_line in download(batch_info[file_key]).splitlines():
+                    if raw_line.strip():
+                        line = json.loads(raw_line)
+                        round_number, subfolder, frame_filenames, cache_key = json.loads(line["custom_id"])
+                        for frame_filename in frame_filenames:
+                            results.setdefault((round_number, subfolder), {})[frame_filename] = line
         
+        # Every requested frame used up one attempt, whether its line is valid, failed or missing
+        for batch in open_batches:
+            for frame_key in batch.get("frames", []):
+                attempts[json.dumps(frame_key)] = attempts.get(json.dumps(frame_key), 0) + 1
+        
+        # Convert to the realtime output layout, one JSON object per video
+        for round_number, subfolder in sorted({tuple(key) for batch in open_batches for key in batch["videos"]}):
+            round_state = round_states.get(round_number)
+            if round_state is None or subfolder in round_state["processed_files"]:
+                continue  # Left pending for the next run
+            video = round_video_inputs(folder_path, subfolder, round_state)
+            final_frames = {frame["frame_filename"] for frame in video["frames"]
+                            if attempts.get(json.dumps([round_number, subfolder, frame["frame_filename"]]), 0) >= max_attempts}
+            frame_results = batch_video_results(video, results.get((round_number, subfolder), {}),
+                                                round_state["journal"], cache, final_frames)
+            if frame_results is not None:
+                save_video_results(video, frame_results, round_state)
+        
+        for batch in open_batches:
+            batch["converted"] = True
+        save_state()
+    
+    for round_state in round_states.values():
+        round_state["journal"].close()
+    if cache is not None:
+        cache.print_summary()
+
 #%% Prompt - IMPROVED VERSION
 
 prompt = """
@@ -495,12 +1855,28 @@ Making fun of someone:?
 Inequal:?
 """
 
+# Canonical feature order: the lines of the prompt that end in ":?" (the order of the JSON output formats)
+FEATURES = [line.strip()[:-2].strip() for line in prompt.splitlines() if line.strip().endswith(':?')]
+
 #%% Loop for number of run
 
-# Loop through rounds (e.g., from 1 to 5)
-for round_num in range(first_round, last_round + 1):
-    round_number = round_num
-    output_folder = f'{output_folder_base}_{round_number}'
-    print(f"Starting round {round_number}")
-    process_media_files(folder_path, round_number, output_folder=output_folder)
-    print(f"Round {round_number} completed.")
\ No newline at end of file
+if __name__ == '__main__' and rating_mode == 'batch':
+    # All rounds go into the same batch submission
+    rounds = [(round_number, f'{output_folder_base}_{round_number}') for round_number in range(first_round, last_round + 1)]
+    process_rounds_batch(folder_path, rounds, batch_folder=f'{output_folder_base}_batch')
+
+elif __name__ == '__main__' and concurrent_rounds:
+    # (round, video, frame) requests of all rounds are interleaved; each round still has its own output folder
+    rounds = [(round_number, f'{output_folder_base}_{round_number}') for round_number in range(first_round, last_round + 1)]
+    print(f"Starting rounds {first_round} to {last_round}")
+    run_async(rate_rounds(folder_path, rounds))
+    print(f"Rounds {first_round} to {last_round} completed.")
+
+elif __name__ == '__main__':
+    # Loop through rounds (e.g., from 1 to 5)
+    for round_num in range(first_round, last_round + 1):
+        round_number = round_num
+        output_folder = f'{output_folder_base}_{round_number}'
+        print(f"Starting round {round_number}")
+        process_media_files(folder_path, round_number, output_folder=output_folder)
+        print(f"Round {round_number} completed.")
\ No newline at end of file
@@ -3,8 +3,11 @@ import json
 import pandas as pd
 import numpy as np
 import re
-import shutil
-import os
+from collections import Counter
+
+# Splits responses to requests that packed several frames (step3's frames_per_request) and
+# decodes the JSON output formats, whose ratings are in the canonical FEATURES order
+from step3_gpt_api_frame_ratings import split_pack_blocks, is_json_content, decode_ratings, FEATURES
 
 #%% Change parameters
 
@@ -17,213 +20,411 @@ extra_round = 0 # This value is default
 # Basic path
 basic_path = Path(r'') # CHANGE
 
-# Image source folder and next round target folder
-source_folder = 'path/stimulus_frames' # CHANGE
-target_folder = f'path/stimulus_frames_round_{round_number}_{extra_round}' # CHANGE
+# Frames with all features missing are listed here; step3's reprocess_manifest re-rates only them in the next extra round
+reprocess_manifest_path = basic_path / f'dataset_{round_number}/frames_to_reprocess_{round_number}_{extra_round}.csv'
 
-#%% Convert json file to csv file
+# Metadata columns (everything else is a feature)
+metadata_columns = ['video', 'frame_number', 'frame_filename', 'propagated_from']
 
-file_path = basic_path / f'dataset_{round_number}/output_{round_number}_{extra_round}.json'
+# Frames written to the CSV at a time
+csv_chunk_rows = 5000
 
-# Function to read a JSON string and extract the desired content (per-frame version)
-def load_and_extract(file_path):
-    extracted_data = []
-    
-    # Open the file and read line by line
-    with open(file_path, 'r', encoding='utf-8') as file:
-        json_object = ''
-        for line in file:
-            json_object += line.strip()
-            if line.startswith('}'):  # Checks if the line indicates the end of a JSON object
-                try:
-                    # Parse the JSON object
-                    data = json.loads(json_object)
-                    # Reset the JSON object string
-                    json_object = ''
-                    
-                    # Check if this is a video object with frames
-                    if 'subfolder' in data and 'frames' in data:
-                        subfolder = data['subfolder']
-                        
-                        # Process each frame
-                        for frame_data in data['frames']:
-                            frame_number = frame_data.get('frame_number', 'unknown')
-                            frame_filename = frame_data.get('frame_filename', 'unknown')
-                            
-                            # Extract content from the response
-                            response = frame_data.get('response', {})
-                            
-                            if 'error' in response:
-                                content = response['error'].get('message', '')
-                            elif 'choices' in response and len(response['choices']) > 0:
-                                content = response['choices'][0]['message']['content']
-                            else:
-                                content = ''
-                            
-                            # Store with metadata
-                            extracted_data.append({
-                                'video': subfolder,
-                                'frame_number': frame_number,
-                                'frame_filename': frame_filename,
-                                'content': content
-                            })
-                    
-                    # Handle old format (single video response) for backwards compatibility
-                    elif 'error' in data:
-                        content = data['error'].get('message', '')
-                        extracted_data.append({
-                            'video': 'unknown',
-                            'frame_number': 0,
-                            'frame_filename': 'unknown',
-                            'content': content
-                        })
-                    elif 'choices' in data and len(data['choices']) > 0:
-                        content = data['choices'][0]['message']['content']
-                        extracted_data.append({
-                            'video': 'unknown',
-                            'frame_number': 0,
-                            'frame_filename': 'unknown',
-                            'content': content
-                        })
-                        
-                except json.JSONDecodeError as e:
-                    print(f"Error decoding JSON: {e}")
-                    # Reset the JSON object string in case of a decoding error
-                    json_object = ''
-
-    return extracted_data
-
-# Load and extract the contents of the JSON file
-extracted_data = load_and_extract(file_path)
-
-# FIXED: Function for parsing individual text content
-def parse_content(content):
+# File format of the tables of steps 4-6: 'csv', 'parquet' or 'feather' (both need pyarrow)
+table_format = 'csv'
+
+#%% Table files
+
+TABLE_EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+def typed_columns(df):
     """
-    Parse content in format: "Feature: Score"
-    Example: "Dominant: 10  \nUnpleasant: 80"
+    Video names as a category, frame numbers as (nullable) integers and integer ratings as nullable
+    uint8 (1 byte per score instead of 8); averaged ratings stay floats
     """
-    # Check if the content is unavailable or empty
-    if not content or content.strip().startswith("{I'm sorry}"):
-        return {"Data Unavailable": np.nan}
+    if 'video' in df.columns:
+        df['video'] = df['video'].astype('category')
+    if 'frame_number' in df.columns:
+        df['frame_number'] = pd.to_numeric(df['frame_number'], errors='coerce').astype('Int64')
+    for column in df.columns.intersection(FEATURES):
+        if pd.api.types.is_integer_dtype(df[column]) and df[column].dtype != 'UInt8':
+            df[column] = df[column].astype('UInt8')
+    return df
+
+def table_columns(path):
+    """ Column names of a table file, without reading its data """
+    suffix = Path(path).suffix
+    if suffix == '.parquet':
+        import pyarrow.parquet as pq
+        return pq.read_schema(path).names
+    if suffix == '.feather':
+        import pyarrow as pa
+        with pa.memory_map(str(path)) as source:
+            return pa.ipc.open_file(source).schema.names
+    return pd.read_csv(path, nrows=0).columns.tolist()
 
-    # Split the content string into lines
-    lines = content.split('\n')
+def read_table(path, columns=None):
+    """
+    Read a table written by write_table or TableWriter (the format follows the extension).
+    columns loads only those columns, in that order; the ones the table does not have are skipped
+    """
+    if columns is not None:
+        available = set(table_columns(path))
+        columns = [column for column in columns if column in available]
+    # Nullable dtypes keep integer ratings with missing values as integers (plain pandas would make them floats)
+    suffix = Path(path).suffix
+    if suffix == '.parquet':
+        df = pd.read_parquet(path, columns=columns, dtype_backend='numpy_nullable')
+    elif suffix == '.feather':
+        df = pd.read_feather(path, columns=columns, dtype_backend='numpy_nullable')
+    else:
+        df = pd.read_csv(path, usecols=columns, dtype_backend='numpy_nullable')
+        if columns is not None:
+            df = df[columns]
+    return typed_columns(df)
+
+def write_table(df, path):
+    """ Write a DataFrame as CSV, Parquet or Feather (the format follows the extension) """
+    df = typed_columns(df.copy())
+    suffix = Path(path).suffix
+    if suffix == '.parquet':
+        df.to_parquet(path, index=False)
+    elif suffix == '.feather':
+        df.reset_index(drop=True).to_feather(path)
+    else:
+        df.to_csv(path, index=False)
+
+class TableWriter:
+    """ Write a table chunk by chunk: appended CSV, Parquet row groups or Feather record batches """
+    
+    def __init__(self, path):
+        self.path = path
+        self.suffix = Path(path).suffix
+        self.writer = None
+        self.schema = None
+        self.header = True
     
-    # Prepare a dictionary to hold the feature-score pairs
-    feature_scores = {}
+    def write(self, df):
+        df = typed_columns(df)
+        if self.suffix not in ('.parquet', '.feather'):
+            df.to_csv(self.path, mode='w' if self.header else 'a', header=self.header, index=False)
+            self.header = False
+            return
+        
+        import pyarrow as pa
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            # Categories differ between chunks, so store them as plain strings (read_table restores the category)
+            self.schema = pa.schema([pa.field(field.name, field.type.value_type) if pa.types.is_dictionary(field.type)
+                                     else field for field in table.schema])
+            if self.suffix == '.parquet':
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(str(self.path), self.schema)
+            else:
+                self.writer = pa.ipc.new_file(str(self.path), self.schema)
+        self.writer.write_table(table.cast(self.schema))
+    
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+#%% Convert json file to csv file
+
+file_path = basic_path / f'dataset_{round_number}/output_{round_number}_{extra_round}.json'
+
+# Frame journal written by step3 (one JSON line per frame); used instead of file_path when it exists
+journal_path = basic_path / f'dataset_{round_number}/output_{round_number}_{extra_round}.jsonl'
+
+# Function to extract the content and metadata of one frame result
+def extract_frame(subfolder, frame_data):
+    frame_number = frame_data.get('frame_number', 'unknown')
+    frame_filename = frame_data.get('frame_filename', 'unknown')
+    # Set when step3 copied the ratings from a near-duplicate frame
+    propagated_from = frame_data.get('propagated_from', '')
     
-    # FIXED: Simplified regex for "Feature: Score" format with flexible whitespace
-    # This matches: "Feature: 10", "Feature: 10  ", "Feature:10", etc.
-    line_regex = re.compile(r'^([^:]+):\s*(\d+)\s*$')
+    # Extract content from the response
+    response = frame_data.get('response', {})
     
-    parsed_count = 0
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-            
-        match = line_regex.match(line)
-        if match:
-            feature, score = match.groups()
-            try:
-                # Convert score to float and store in the dictionary
-                feature_scores[feature.strip()] = float(score)
-                parsed_count += 1
-            except ValueError:
-                # Handle the case where conversion fails
-                feature_scores[feature.strip()] = np.nan
+    if 'error' in response:
+        content = response['error'].get('message', '')
+    elif 'choices' in response and len(response['choices']) > 0:
+        content = response['choices'][0]['message']['content']
+    else:
+        content = ''
     
-    # Optional: Print warning if very few features were parsed
-    if parsed_count == 0 and len(lines) > 5:
-        print(f"Warning: No features parsed from content with {len(lines)} lines")
-        print(f"First line sample: '{lines[0][:100]}'")
+    # A packed response holds the ratings of several frames; keep only this frame's block
+    if 'pack' in frame_data:
+        content = split_pack_blocks(content).get(frame_data['pack'], '')
     
-    return feature_scores if feature_scores else {"Data Unavailable": np.nan}
-
-# Parse all extracted content and combine with metadata
-parsed_data = []
-for item in extracted_data:
-    parsed_features = parse_content(item['content'])
-    # Combine metadata with parsed features
-    row_data = {
-        'video': item['video'],
-        'frame_number': item['frame_number'],
-        'frame_filename': item['frame_filename'],
-        **parsed_features  # Unpack all feature scores
+    # Store with metadata
+    return {
+        'video': subfolder,
+        'frame_number': frame_number,
+        'frame_filename': frame_filename,
+        'propagated_from': propagated_from,
+        'content': content
     }
-    parsed_data.append(row_data)
 
-# Create a DataFrame from the results
-df = pd.DataFrame(parsed_data)
+# Whitespace between two JSON values
+JSON_WHITESPACE = re.compile(r'\s*')
 
-# Save the DataFrame as a CSV file
-output_csv_path = basic_path / f'dataset_{round_number}/output_{round_number}_{extra_round}.csv'
-df.to_csv(output_csv_path, index=False)
+def iter_json_objects(file_path, read_size=1 << 20):
+    """
+    Yield the JSON values of a file of concatenated JSON objects (step3's indent=4 output) or of JSON
+    lines (the frame journal), reading it in chunks and decoding incrementally with raw_decode.
+    A value that cannot be decoded (e.g. cut off by a crash) is skipped up to the next line starting with '{'
+    """
+    decoder = json.JSONDecoder()
+    with open(file_path, 'r', encoding='utf-8') as file:
+        buffer = ''
+        position = 0
+        at_end = False
+        while True:
+            position = JSON_WHITESPACE.match(buffer, position).end()
+            if position == len(buffer):
+                if at_end:
+                    return
+                buffer = file.read(read_size)
+                position = 0
+                at_end = not buffer
+                continue
+            try:
+                value, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as e:
+                # Top-level objects start at the beginning of a line; nested ones are indented and
+                # strings cannot hold a raw newline, so an object start further on means this value is broken
+                next_object = buffer.find('\n{', position)
+                if next_object == -1 and not at_end:
+                    # The value continues in the next chunk; read at least as much as is buffered
+                    more = file.read(max(read_size, len(buffer) - position))
+                    buffer = buffer[position:] + more
+                    position = 0
+                    at_end = not more
+                    continue
+                print(f"Error decoding JSON: {e}")
+                if next_object == -1:
+                    return
+                position = next_object + 1
+                continue
+            yield value
+            
+            # Drop the decoded text from the buffer
+            if position >= read_size:
+                buffer = buffer[position:]
+                position = 0
 
-print(f"✓ CSV file created: {output_csv_path}")
-print(f"  Total frames processed: {len(df)}")
-print(f"  Unique videos: {df['video'].nunique()}")
-print(f"  Total columns (features): {len(df.columns)}")
-print(f"  Feature columns: {len([col for col in df.columns if col not in ['video', 'frame_number', 'frame_filename']])}")
+# Yield the extracted content of every frame result of a step3 output file (frame journal or per-video JSON)
+def iter_frames(file_path):
+    for data in iter_json_objects(file_path):
+        # Check if this is a video object with frames
+        if 'subfolder' in data and 'frames' in data:
+            subfolder = data['subfolder']
+            
+            # Process each frame
+            for frame_data in data['frames']:
+                yield extract_frame(subfolder, frame_data)
+        
+        # One frame result of the frame journal
+        elif 'subfolder' in data and 'frame_filename' in data:
+            yield extract_frame(data['subfolder'], data)
+        
+        # Handle old format (single video response) for backwards compatibility
+        elif 'error' in data:
+            content = data['error'].get('message', '')
+            yield {
+                'video': 'unknown',
+                'frame_number': 0,
+                'frame_filename': 'unknown',
+                'propagated_from': '',
+                'content': content
+            }
+        elif 'choices' in data and len(data['choices']) > 0:
+            content = data['choices'][0]['message']['content']
+            yield {
+                'video': 'unknown',
+                'frame_number': 0,
+                'frame_filename': 'unknown',
+                'propagated_from': '',
+                'content': content
+            }
 
-#%% Check missing frames and copy videos to new folder
+# Column of each feature in the ratings array: the order of the features in step3's prompt
+FEATURE_INDEX = {feature: index for index, feature in enumerate(FEATURES)}
 
-# Find rows where all feature values are missing (excluding metadata columns)
-feature_columns = [col for col in df.columns if col not in ['video', 'frame_number', 'frame_filename']]
-empty_rows = df.index[df[feature_columns].isnull().all(axis=1)].tolist()
+# Ratings are integers from 0 to RATING_MAX; other scores count as missing
+RATING_MAX = 100
 
-# Find rows with at least one missing feature value
-nan_rows = df.index[df[feature_columns].isnull().any(axis=1)].tolist()
+# "Feature: Score" lines of a response, with flexible whitespace after the colon ("Feature: 10", "Feature:10  ", ...)
+RATING_LINE_PATTERN = re.compile(r'^([^:\n]+):[ \t]*(\d{1,9})[ \t]*\r?$', re.MULTILINE)
 
-# Create a DataFrame containing only rows with at least one missing value
-nan_rows_df = df[df[feature_columns].isnull().any(axis=1)]
+def parse_ratings(contents, ratings, valid, unknown_features):
+    """
+    Fill ratings, a preallocated (len(contents), len(FEATURES)) uint8 array, and valid, a boolean array of
+    the same shape, with the scores of each response content in a single pass. Content is "Feature: Score"
+    lines or a JSON array of scores in FEATURES order (step3's JSON output formats). Features a response
+    leaves out stay invalid; names that are not in FEATURES are counted in unknown_features (a Counter)
+    instead of getting a column
+    """
+    valid[:] = False
+    for row, content in enumerate(contents):
+        # Unavailable or empty content
+        if not content or content.lstrip().startswith("{I'm sorry}"):
+            continue
+        
+        # JSON output formats: an array of ratings in FEATURES order
+        if is_json_content(content):
+            try:
+                scores = decode_ratings(content)
+            except json.JSONDecodeError:
+                scores = None
+            # Only an array of exactly len(FEATURES) ratings can be mapped by position; a shorter or
+            # longer one would shift the features after the dropped or extra item, so all are missing
+            if isinstance(scores, list) and len(scores) == len(FEATURES):
+                columns = [column for column, score in enumerate(scores)
+                           if type(score) is int and 0 <= score <= RATING_MAX]
+                ratings[row, columns] = [scores[column] for column in columns]
+                valid[row, columns] = True
+            continue
+        
+        matches = RATING_LINE_PATTERN.findall(content)
+        if matches:
+            features, scores = zip(*matches)
+            columns = list(map(FEATURE_INDEX.get, features))
+            if None in columns:
+                # Names with stray whitespace or that are not in FEATURES (the uncommon case)
+                columns = [FEATURE_INDEX.get(feature.strip()) for feature in features]
+                for feature, column in zip(features, columns):
+                    if column is None:
+                        unknown_features[feature.strip()] += 1
+                scores = [score for score, column in zip(scores, columns) if column is not None]
+                columns = [column for column in columns if column is not None]
+            scores = np.array(scores, dtype=np.int64)
+            columns = np.array(columns, dtype=np.intp)[scores <= RATING_MAX]
+            ratings[row, columns] = scores[scores <= RATING_MAX]
+            valid[row, columns] = True
+            continue
+        
+        # Warn when a long answer has no rating line at all
+        line_count = content.count('\n') + 1
+        if line_count > 5:
+            print(f"Warning: No features parsed from content with {line_count} lines")
+            print(f"First line sample: '{content.lstrip().splitlines()[0][:100]}'")
+
+# Group the frames into lists of at most size frames
+def iter_chunks(frames, size):
+    chunk = []
+    for item in frames:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# Parse the frames as they are read and write the table in chunks, so memory use does not grow with the file
+input_path = journal_path if journal_path.exists() else file_path
+output_table_path = basic_path / f'dataset_{round_number}/output_{round_number}_{extra_round}{TABLE_EXTENSIONS[table_format]}'
+
+# Fixed columns: metadata, then the features in the order of step3's prompt
+csv_columns = metadata_columns + FEATURES
+feature_columns = FEATURES
+known_features = set(FEATURES)
 
-# Find feature columns with at least one missing value
-columns_with_null = df[feature_columns].columns[df[feature_columns].isnull().any()].tolist()
+if __name__ == '__main__':
+    # Statistics collected while streaming
+    total_frames = 0
+    propagated_frames = 0
+    videos = set()
+    unknown_features = Counter()  # Name -> occurrences of feature names that are not in FEATURES
+    empty_rows = 0  # Frames with all features missing
+    nan_rows = 0  # Frames with at least one feature missing
+    missing_per_feature = np.zeros(len(FEATURES), dtype=np.int64)
+    frames_to_reprocess = []  # (video, frame_number, frame_filename) of the frames with all features missing
 
-# Find feature columns with all values missing
-all_null_columns = df[feature_columns].columns[df[feature_columns].isnull().all()].tolist()
+    # Ratings of one chunk of frames and which of them are present, allocated once
+    # (column-major, so every feature column is one contiguous block)
+    ratings = np.zeros((csv_chunk_rows, len(FEATURES)), dtype=np.uint8, order='F')
+    valid = np.zeros((csv_chunk_rows, len(FEATURES)), dtype=bool, order='F')
 
-print(f"\n=== Missing Data Summary ===")
-print(f"Frames with all features missing: {len(empty_rows)}")
-print(f"Frames with some features missing: {len(nan_rows)}")
-print(f"Features with some missing values: {len(columns_with_null)}")
-print(f"Features with all missing values: {len(all_null_columns)}")
+    writer = TableWriter(output_table_path)
+    first_chunk = True
+    for chunk in iter_chunks(iter_frames(input_path), csv_chunk_rows):
+        chunk_ratings = ratings[:len(chunk)]
+        chunk_valid = valid[:len(chunk)]
+        parse_ratings([item['content'] for item in chunk], chunk_ratings, chunk_valid, unknown_features)
+        
+        # Update the statistics
+        missing = ~chunk_valid
+        missing_per_feature += missing.sum(axis=0)
+        empty = missing.all(axis=1)
+        empty_rows += int(empty.sum())
+        nan_rows += int(missing.any(axis=1).sum())
+        for item, is_empty in zip(chunk, empty):
+            if is_empty:
+                frames_to_reprocess.append((item['video'], item['frame_number'], item['frame_filename']))
+        total_frames += len(chunk)
+        videos.update(item['video'] for item in chunk)
+        propagated_frames += sum(1 for item in chunk if item['propagated_from'])
+        
+        # Combine metadata with the ratings (nullable uint8 columns over the buffers)
+        ratings_df = pd.DataFrame({feature: pd.arrays.IntegerArray(chunk_ratings[:, column], missing[:, column])
+                                   for column, feature in enumerate(FEATURES)})
+        chunk_df = pd.concat([pd.DataFrame([[item[column] for column in metadata_columns] for item in chunk],
+                                           columns=metadata_columns),
+                              ratings_df], axis=1)
+        writer.write(chunk_df)
+        first_chunk = False
+    
+    # Just the columns when there are no frames
+    if first_chunk:
+        writer.write(pd.DataFrame(columns=csv_columns))
+    writer.close()
 
-if all_null_columns:
-    print(f"\nFeatures with all values missing:")
-    for col in all_null_columns[:10]:  # Show first 10
-        print(f"  - {col}")
+    print(f"✓ {table_format} file created: {output_table_path}")
+    print(f"  Total frames processed: {total_frames}")
+    print(f"  Unique videos: {len(videos)}")
+    print(f"  Total columns (features): {len(csv_columns)}")
+    print(f"  Feature columns: {len(feature_columns)}")
+    print(f"  Frames with propagated ratings: {propagated_frames}")
+    if unknown_features:
+        print(f"  ⚠️ Feature names not in the prompt (not written): {len(unknown_features)}")
+        for feature, count in unknown_features.most_common(10):
+            print(f"    - {feature!r}: {count} times")
 
-# Get unique videos that have frames with missing data
-videos_with_missing_frames = df.loc[empty_rows, 'video'].unique().tolist()
+#%% Check missing frames and list them for reprocessing
 
-print(f"\nVideos with completely missing frames: {len(videos_with_missing_frames)}")
+if __name__ == '__main__':
+    # Find feature columns with at least one missing value
+    columns_with_null = [feature for feature, count in zip(FEATURES, missing_per_feature) if count > 0]
 
-# Copy videos with missing frames to target folder for reprocessing
-if videos_with_missing_frames:
-    os.makedirs(target_folder, exist_ok=True)
+    # Find feature columns with all values missing
+    all_null_columns = [feature for feature, count in zip(FEATURES, missing_per_feature) if total_frames and count == total_frames]
+
+    print(f"\n=== Missing Data Summary ===")
+    print(f"Frames with all features missing: {empty_rows}")
+    print(f"Frames with some features missing: {nan_rows}")
+    print(f"Features with some missing values: {len(columns_with_null)}")
+    print(f"Features with all missing values: {len(all_null_columns)}")
+
+    if all_null_columns:
+        print(f"\nFeatures with all values missing:")
+        for col in all_null_columns[:10]:  # Show first 10
+            print(f"  - {col}")
+
+    # Features that answers leave out most often
+    partly_missing = sorted((count, feature) for feature, count in zip(FEATURES, missing_per_feature) if 0 < count < total_frames)
+    if partly_missing:
+        print(f"\nFeatures missing most often:")
+        for count, feature in partly_missing[::-1][:10]:
+            print(f"  - {feature}: {count} frames")
+
+    # Frames with missing data were collected while streaming
+    videos_to_reprocess = {video for video, frame_number, frame_filename in frames_to_reprocess}
+    print(f"\nVideos with completely missing frames: {len(videos_to_reprocess)}")
     
-    for video_name in videos_with_missing_frames:
-        source_path = os.path.join(source_folder, video_name)
-        target_path = os.path.join(target_folder, video_name)
-        
-        # If the source folder exists, copy it to the target folder
-        if os.path.exists(source_path):
-            if not os.path.exists(target_path):  # Avoid overwriting
-                shutil.copytree(source_path, target_path)
-                print(f"✓ '{video_name}' has been copied to '{target_folder}'.")
-            else:
-                print(f"⚠ '{video_name}' already exists in '{target_folder}', skipping.")
-        else:
-            print(f"✗ '{video_name}' not found in '{source_folder}'.")
-else:
-    print("\n✓ No videos need reprocessing!")
-
-# Optionally save a list of videos needing reprocessing
-if videos_with_missing_frames:
-    reprocess_list_path = basic_path / f'dataset_{round_number}/videos_to_reprocess_{round_number}_{extra_round}.txt'
-    with open(reprocess_list_path, 'w') as f:
-        for video in videos_with_missing_frames:
-            f.write(f"{video}\n")
-    print(f"\n✓ List of videos to reprocess saved to: {reprocess_l}")
\ No newline at end of file
+    # List just those frames for the next extra round (an empty manifest means there is nothing to re-rate)
+    manifest_df = pd.DataFrame(frames_to_reprocess, columns=['video', 'frame_number', 'frame_filename'])
+    manifest_df.to_csv(reprocess_manifest_path, index=False)
+    if frames_to_reprocess:
+        print(f"✓ Reprocessing manifest saved to: {reprocess_manifest_path}")
+    else:
+        print("\n✓ No frames need reprocessing!")
@@ -1,7 +1,13 @@
 from pathlib import Path
 import pandas as pd
+import numpy as np
+import sqlite3
+import re
 import os
 
+# CSV/Parquet/Feather tables with typed metadata columns
+from step4_json_to_csv import read_table, write_table, TableWriter, TABLE_EXTENSIONS
+
 #%% Change parameters
 
 # Round number
@@ -15,122 +21,209 @@ basic_path = Path(r'') # CHANGE
 # 'per_video' - Average ratings across all frames in each video (summary)
 output_format = 'per_frame'  # CHANGE THIS if you want video-level averages
 
-#%% Combine CSV files from different extra rounds
+# File format of the step4 outputs and of the files written here: 'csv', 'parquet' or 'feather' (both need pyarrow)
+table_format = 'csv'
 
-# Directory containing your CSV files
-data_dir = basic_path / f'dataset_{round_number}'
+# SQLite store of the combined frames, keyed by (video, frame_number). Output files merged in an
+# earlier run are skipped, so a new extra round only costs its own frames (delete the file to start over)
+store_path = basic_path / f'dataset_{round_number}' / f'combined_{round_number}.sqlite'
+
+# Row a frame keeps when several output files rate it:
+# 'most_complete' - the one with the most features rated (the later extra round on a tie)
+# 'first_valid' - the first one merged with all features rated (until there is one, the later extra round)
+# 'latest' - the one of the latest extra round
+merge_precedence = 'most_complete'
 
-# Get a list of all output CSV files (not combined ones)
-csv_files = [f for f in os.listdir(data_dir) 
-             if f.startswith('output_') and f.endswith('.csv') and not f.startswith('combined_')]
+# Also write all stored frames, with the file each one was taken from, to combined_all_rounds_{round}
+export_combined = False
 
-print(f"Found {len(csv_files)} CSV files to process")
+# Frames read from the store at a time when writing the per-frame output
+output_chunk_rows = 50000
 
-# Read and combine all CSV files
-all_dataframes = []
+#%% Merge new output files from different extra rounds into the store
 
-for csv_file in csv_files:
-    csv_path = os.path.join(data_dir, csv_file)
+# Directory containing your output files
+data_dir = basic_path / f'dataset_{round_number}'
+extension = TABLE_EXTENSIONS[table_format]
+
+# Metadata columns (everything else is a feature)
+metadata_cols = ['video', 'frame_number', 'frame_filename', 'propagated_from', 'source_file']
+
+# Bookkeeping columns of the store, used by the precedence rule
+STORE_COLUMNS = ['extra_round', 'features_rated']
+
+# Extra round of an output file name, output_{round}_{extra}
+OUTPUT_FILE_PATTERN = re.compile(r'^output_\d+_(\d+)\.')
+
+def quote(column):
+    """ SQL identifier for a column name (feature names contain spaces and slashes) """
+    return '"' + column.replace('"', '""') + '"'
+
+def open_store(path):
+    """ Open (or create) the store: the frames table and the list of merged output files """
+    connection = sqlite3.connect(path)
+    connection.execute("""CREATE TABLE IF NOT EXISTS frames (
+        video TEXT NOT NULL, frame_number INTEGER NOT NULL, frame_filename TEXT, propagated_from TEXT,
+        source_file TEXT, extra_round INTEGER, features_rated INTEGER, PRIMARY KEY (video, frame_number))""")
+    connection.execute("""CREATE TABLE IF NOT EXISTS merged_files (
+        source_file TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, frames INTEGER)""")
+    return connection
+
+def store_feature_columns(connection):
+    """ Feature columns of the frames table, in the order they were added """
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(frames)")]
+    return [column for column in columns if column not in metadata_cols + STORE_COLUMNS]
+
+def upsert_condition(feature_count):
+    """ SQL condition under which a new row (excluded) replaces the stored row (frames) of the same frame """
+    # A file that is merged again (e.g. step4 was rerun) always replaces its own rows
+    same_file = "excluded.source_file = frames.source_file"
+    later = "excluded.extra_round >= frames.extra_round"
+    if merge_precedence == 'latest':
+        return f"{same_file} OR {later}"
+    if merge_precedence == 'first_valid':
+        return (f"{same_file} OR (frames.features_rated < {feature_count} AND "
+                f"(excluded.features_rated = {feature_count} OR {later}))")
+    if merge_precedence == 'most_complete':
+        return (f"{same_file} OR excluded.features_rated > frames.features_rated OR "
+                f"(excluded.features_rated = frames.features_rated AND {later})")
+    raise ValueError(f"merge_precedence must be 'most_complete', 'first_valid' or 'latest', not '{merge_precedence}'")
+
+def merge_file(connection, df, source_file):
+    """ Upsert the frames of one output file into the store. Returns the number of frames merged """
+    feature_cols = [col for col in df.columns if col not in metadata_cols]
+    
+    # Features the store does not have yet get a column
+    stored_features = store_feature_columns(connection)
+    for column in feature_cols:
+        if column not in stored_features:
+            connection.execute(f"ALTER TABLE frames ADD COLUMN {quote(column)} INTEGER")
+            stored_features.append(column)
+    
+    match = OUTPUT_FILE_PATTERN.match(source_file)
+    ratings = df[feature_cols].to_numpy(dtype=np.float64, na_value=np.nan)  # NaN is stored as NULL
+    rows = pd.DataFrame({
+        'video': df['video'].astype(str),
+        'frame_number': df['frame_number'].fillna(0).astype('int64'),  # 0 for frames of unknown number, as step4 writes them
+        'frame_filename': df['frame_filename'].astype(str),
+        'propagated_from': df['propagated_from'].astype('string').fillna('') if 'propagated_from' in df.columns else '',
+        'source_file': source_file,
+        'extra_round': int(match.group(1)) if match else -1,
+        'features_rated': (~np.isnan(ratings)).sum(axis=1)
+    })
+    columns = list(rows.columns) + feature_cols
+    values = [metadata + rating_row for metadata, rating_row in
+              zip(rows.itertuples(index=False, name=None), map(tuple, ratings.tolist()))]
     
-    # Check if the csv file is not empty
-    if os.path.getsize(csv_path) > 0:
+    connection.executemany(
+        f"INSERT INTO frames ({', '.join(map(quote, columns))}) VALUES ({', '.join('?' * len(columns))}) "
+        f"ON CONFLICT (video, frame_number) DO UPDATE SET "
+        f"{', '.join(f'{quote(column)} = excluded.{quote(column)}' for column in columns[2:])} "
+        f"WHERE {upsert_condition(len(stored_features))}",
+        values)
+    return len(values)
+
+connection = open_store(store_path)
+merged_files = {row[0]: row[1:] for row in connection.execute("SELECT source_file, size, mtime_ns FROM merged_files")}
+
+# Get a list of all output files (not combined ones), oldest extra round first
+table_files = [f for f in os.listdir(data_dir)
+               if f.startswith('output_') and f.endswith(extension) and not f.startswith('combined_')]
+table_files.sort(key=lambda f: (int(OUTPUT_FILE_PATTERN.match(f).group(1)) if OUTPUT_FILE_PATTERN.match(f) else -1, f))
+
+print(f"Found {len(table_files)} {table_format} files to process")
+
+# Merge the files that are new or changed since the last run
+for table_file in table_files:
+    table_path = os.path.join(data_dir, table_file)
+    stat = os.stat(table_path)
+    
+    if merged_files.get(table_file) == (stat.st_size, stat.st_mtime_ns):
+        print(f"✓ {table_file} already merged")
+        continue
+    
+    # Check if the file is not empty
+    if stat.st_size > 0:
         try:
-            df = pd.read_csv(csv_path)
+            df = read_table(table_path)
             
             if df.empty:
-                print(f'CSV file {csv_file} is empty after reading. Skipping.')
+                print(f'File {table_file} is empty after reading. Skipping.')
                 continue
             
-            # Add source file column for tracking
-            df['source_file'] = csv_file
-            all_dataframes.append(df)
-            print(f"✓ Loaded {csv_file}: {len(df)} frames")
-            
+            # One transaction per file, so an interrupted run leaves no half-merged file behind
+            with connection:
+                frame_count = merge_file(connection, df, table_file)
+                connection.execute("INSERT OR REPLACE INTO merged_files VALUES (?, ?, ?, ?)",
+                                   (table_file, stat.st_size, stat.st_mtime_ns, frame_count))
+            print(f"✓ Merged {table_file}: {frame_count} frames")
+        
         except pd.errors.EmptyDataError:
-            print(f'CSV file {csv_file} has no columns. Skipping.')
+            print(f'File {table_file} has no columns. Skipping.')
             continue
     else:
-        print(f'CSV file {csv_file} is empty. Skipping.')
+        print(f'File {table_file} is empty. Skipping.')
 
-# Combine all dataframes
-if all_dataframes:
-    combined_df = pd.concat(all_dataframes, ignore_index=True)
-    print(f"\n✓ Combined {len(all_dataframes)} files into {len(combined_df)} total frames")
-else:
+feature_cols = store_feature_columns(connection)
+total_frames = connection.execute("SELECT COUNT(*) FROM frames").fetchone()[0]
+if not total_frames:
     print("No data to combine!")
     exit()
+print(f"\n✓ Store {store_path}: {total_frames} frames (precedence: {merge_precedence})")
 
-# Save combined raw data
-combined_output_path = os.path.join(data_dir, f'combined_all_rounds_{round_number}.csv')
-combined_df.to_csv(combined_output_path, index=False)
-print(f"✓ Combined file saved as {combined_output_path}")
-
-#%% Remove duplicates and handle missing data
-
-# Get feature columns (exclude metadata columns)
-metadata_cols = ['video', 'frame_number', 'frame_filename', 'source_file']
-feature_cols = [col for col in combined_df.columns if col not in metadata_cols]
-
-# Remove duplicate frames (keeping the first occurrence)
-print(f"\nChecking for duplicates...")
-before_dedup = len(combined_df)
-combined_df = combined_df.drop_duplicates(subset=['video', 'frame_number'], keep='first')
-after_dedup = len(combined_df)
-if before_dedup > after_dedup:
-    print(f"✓ Removed {before_dedup - after_dedup} duplicate frames")
-else:
-    print(f"✓ No duplicates found")
+#%% Handle missing data
 
 # Check for missing values
-missing_count = combined_df[feature_cols].isnull().sum().sum()
+missing_count = connection.execute(f"SELECT SUM({len(feature_cols)} - features_rated) FROM frames").fetchone()[0]
 print(f"\nMissing feature values: {missing_count}")
 
+# Export the stored frames with their source file
+if export_combined:
+    combined_df = pd.read_sql_query("SELECT * FROM frames ORDER BY video, frame_number", connection)
+    combined_df = combined_df.drop(columns=STORE_COLUMNS)
+    combined_df[feature_cols] = combined_df[feature_cols].astype('UInt8')
+    combined_output_path = os.path.join(data_dir, f'combined_all_rounds_{round_number}{extension}')
+    write_table(combined_df, combined_output_path)
+    print(f"✓ Combined file saved as {combined_output_path}")
+
 #%% Process based on chosen format
 
 if output_format == 'per_frame':
-    # Keep per-frame data, just clean it
+    # Keep per-frame data, read from the store in video and frame order
     print(f"\n=== Per-Frame Output ===")
     
-    cleaned_df = combined_df.copy()
-    
-    # Sort by video name and frame number
-    sorted_df = cleaned_df.sort_values(by=['video', 'frame_number'])
-    
-    # Drop the source_file column (not needed in final output)
-    final_df = sorted_df.drop(columns=['source_file'])
-    
-    print(f"✓ Final dataset: {len(final_df)} frames from {final_df['video'].nunique()} videos")
+    query = (f"SELECT video, frame_number, frame_filename, propagated_from, {', '.join(map(quote, feature_cols))} "
+             f"FROM frames ORDER BY video, frame_number")
     
     # Save final per-frame output
-    output_path = basic_path / 'average' / 'input' / f'final_output_{round_number}_per_frame.csv'
+    output_path = basic_path / 'average' / 'input' / f'final_output_{round_number}_per_frame{extension}'
     os.makedirs(output_path.parent, exist_ok=True)
-    final_df.to_csv(output_path, index=False)
+    writer = TableWriter(output_path)
+    for chunk_df in pd.read_sql_query(query, connection, chunksize=output_chunk_rows):
+        chunk_df[feature_cols] = chunk_df[feature_cols].astype('UInt8')
+        writer.write(chunk_df)
+    writer.close()
+    
+    video_count = connection.execute("SELECT COUNT(DISTINCT video) FROM frames").fetchone()[0]
+    print(f"✓ Final dataset: {total_frames} frames from {video_count} videos")
     print(f"✓ Saved: {output_path}")
 
 elif output_format == 'per_video':
     # Aggregate frames into video-level averages
     print(f"\n=== Per-Video Output (Averaging Frames) ===")
     
-    # Remove frames where ALL features are missing
-    cleaned_df = combined_df.dropna(subset=feature_cols, how='all')
-    
-    # Group by video and calculate mean for each feature
-    video_averages = cleaned_df.groupby('video')[feature_cols].mean().reset_index()
-    
-    # Count frames per video
-    frame_counts = cleaned_df.groupby('video').size().reset_index(name='frame_count')
-    video_averages = video_averages.merge(frame_counts, on='video')
-    
-    # Sort by video name
-    sorted_df = video_averages.sort_values(by='video')
+    # Average each feature over the frames of a video, leaving out frames where ALL features are missing
+    query = (f"SELECT video, {', '.join(f'AVG({quote(column)}) AS {quote(column)}' for column in feature_cols)}, "
+             f"COUNT(*) AS frame_count FROM frames WHERE features_rated > 0 GROUP BY video ORDER BY video")
+    sorted_df = pd.read_sql_query(query, connection)
     
     print(f"✓ Final dataset: {len(sorted_df)} videos")
     print(f"  Average frames per video: {sorted_df['frame_count'].mean():.1f}")
     
     # Save final per-video output
-    output_path = basic_path / 'average' / 'input' / f'final_output_{round_number}_per_video.csv'
+    output_path = basic_path / 'average' / 'input' / f'final_output_{round_number}_per_video{extension}'
     os.makedirs(output_path.parent, exist_ok=True)
-    sorted_df.to_csv(output_path, index=False)
+    write_table(sorted_df, output_path)
     print(f"✓ Saved: {output_path}")
 
 else:
@@ -139,18 +232,20 @@ else:
 #%% Generate summary statistics
 
 print(f"\n=== Summary Statistics ===")
-print(f"Total unique videos: {combined_df['video'].nunique()}")
-print(f"Total frames analyzed: {len(combined_df)}")
-print(f"Average frames per video: {len(combined_df) / combined_df['video'].nunique():.1f}")
+frames_per_video = pd.read_sql_query(
+    "SELECT video, COUNT(*) AS frames FROM frames GROUP BY video ORDER BY frames DESC, video", connection)
+print(f"Total unique videos: {len(frames_per_video)}")
+print(f"Total frames analyzed: {total_frames}")
+print(f"Average frames per video: {total_frames / len(frames_per_video):.1f}")
 
 # Show videos with most/least frames
-frames_per_video = combined_df.groupby('video').size().sort_values(ascending=False)
-print(f"\nVideo with most frames: {frames_per_video.index[0]} ({frames_per_video.iloc[0]} frames)")
-print(f"Video with least frames: {frames_per_video.index[-1]} ({frames_per_video.iloc[-1]} frames)")
+print(f"\nVideo with most frames: {frames_per_video['video'].iloc[0]} ({frames_per_video['frames'].iloc[0]} frames)")
+print(f"Video with least frames: {frames_per_video['video'].iloc[-1]} ({frames_per_video['frames'].iloc[-1]} frames)")
 
 # Check data completeness
-complete_rows = combined_df[feature_cols].notna().all(axis=1).sum()
-completion_rate = (complete_rows / len(combined_df)) * 100
+complete_rows = connection.execute(f"SELECT COUNT(*) FROM frames WHERE features_rated = {len(feature_cols)}").fetchone()[0]
+completion_rate = (complete_rows / total_frames) * 100
 print(f"\nData completeness: {completion_rate:.1f}% of frames have all features rated")
 
-print("\n✓ Processing complete!")
\ No newline at end of file
+connection.close()
+print("\n✓ Processing complete!")
@@ -1,8 +1,12 @@
 import os
+import numpy as np
 import pandas as pd
 import glob
 from itertools import combinations
 
+# CSV/Parquet/Feather tables with typed metadata columns
+from step4_json_to_csv import read_table, write_table, TABLE_EXTENSIONS
+
 #%% Change parameters
 
 # Number of files
@@ -12,14 +16,21 @@ number_of_files = 5
 input_dir = r'' #CHANGE
 output_dir = r'' #CHANGE
 
+# File format of the input and output files: 'csv', 'parquet' or 'feather' (both need pyarrow)
+table_format = 'csv'
+
+# Features to average ([] = all); only these columns are loaded
+features = []
+
 #%% Script
 
-# Reading all CSV files from directory
-csv_files = glob.glob(os.path.join(input_dir, "*.csv"))
-csv_files.sort()
+# Reading all files of the table format from directory
+extension = TABLE_EXTENSIONS[table_format]
+input_files = glob.glob(os.path.join(input_dir, f"*{extension}"))
+input_files.sort()
 
-# Check number of csv files
-assert len(csv_files) == number_of_files, f"Expected {number_of_files} files, but found {len(csv_files)}"
+# Check number of input files
+assert len(input_files) == number_of_files, f"Expected {number_of_files} files, but found {len(input_files)}"
 
 # FIXED: Average function for per-frame structure
 def process_files(files):
@@ -27,9 +38,13 @@ def process_files(files):
     
     # Metadata columns (these will NOT be averaged)
     metadata_columns = ['video', 'frame_number', 'frame_filename']
+    optional_metadata_columns = ['propagated_from']  # Only in outputs of step4 with frame deduplication
+    
+    # Load only the selected features (and the metadata)
+    columns = metadata_columns + optional_metadata_columns + features if features else None
     
     for i, file in enumerate(files):
-        df = pd.read_csv(file)
+        df = read_table(file, columns=columns)
         
         # Verify metadata columns exist
         if i == 0:
@@ -40,23 +55,27 @@ def process_files(files):
         dfs.append(df)
     
     # Take metadata from the first file
-    metadata_df = dfs[0][metadata_columns].copy()
+    present_optional_columns = [col for col in optional_metadata_columns if col in dfs[0].columns]
+    metadata_df = dfs[0][metadata_columns + present_optional_columns].copy()
     
-    # Extract only feature columns (everything except metadata) from all files
-    feature_dfs = []
-    for df in dfs:
-        # Get only the feature columns (exclude metadata)
-        feature_cols = [col for col in df.columns if col not in metadata_columns]
-        feature_dfs.append(df[feature_cols])
+    # Feature columns (everything except metadata) of all files, in name order
+    feature_cols = sorted({col for df in dfs for col in df.columns if col not in metadata_columns + optional_metadata_columns})
     
-    # Concatenate all feature dataframes along columns (side by side)
-    # This creates a dataframe where each feature appears multiple times (once per file)
-    combined_features = pd.concat(feature_dfs, axis=1)
+    # Sum and count the ratings of each frame and feature over the files, one file at a time;
+    # the compact uint8 ratings are only widened here, to compute the average
+    n_rows = max(len(df) for df in dfs)
+    sums = np.zeros((n_rows, len(feature_cols)))
+    counts = np.zeros((n_rows, len(feature_cols)), dtype=np.int32)
+    for df in dfs:
+        ratings = df.reindex(columns=feature_cols).to_numpy(dtype=np.float64, na_value=np.nan)
+        valid = ~np.isnan(ratings)
+        sums[:len(df)] += np.where(valid, ratings, 0)
+        counts[:len(df)] += valid
     
-    # Group by column names and calculate mean
-    # This averages all columns with the same name across different files
-    # Transpose, group, mean, then transpose back to fix deprecation warning
-    averaged_features = combined_features.T.groupby(level=0).mean().T
+    # Mean over the files that rated the feature (NaN when none did)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        averages = sums / counts
+    averaged_features = pd.DataFrame(averages, columns=feature_cols)
     
     # Combine metadata with averaged features
     final_df = pd.concat([metadata_df, averaged_features], axis=1)
@@ -72,8 +91,8 @@ os.makedirs(output_dir, exist_ok=True)
 print(f"\n=== Starting averaging process ===")
 print(f"Input directory: {input_dir}")
 print(f"Output directory: {output_dir}")
-print(f"Number of CSV files found: {len(csv_files)}")
-print(f"Files: {[os.path.basename(f) for f in csv_files]}\n")
+print(f"Number of {table_format} files found: {len(input_files)}")
+print(f"Files: {[os.path.basename(f) for f in input_files]}\n")
 
 # Loop over 2, 3, 4, and 5 files (or whatever range you specified)
 for n_files in range(loop_start_num, loop_end_num):
@@ -81,26 +100,27 @@ for n_files in range(loop_start_num, loop_end_num):
     
     # Generate all combinations of n_files from the list of CSV files
     combo_count = 0
-    for selected_files in combinations(csv_files, n_files):
+    for selected_files in combinations(input_files, n_files):
         result_df = process_files(selected_files)
         
         # Create the output filename
         # Get the file indices (+1 to make them 1-based)
-        selected_files_indices = [csv_files.index(f) + 1 for f in selected_files]
+        selected_files_indices = [input_files.index(f) + 1 for f in selected_files]
         
         # Join the indices into a string separated by underscores
         selected_files_str = "_".join(map(str, selected_files_indices))
         
         # Create the filename with n_files and the selected files' indices
-        output_filename = f'output_average_{n_files}_files_{selected_files_str}.csv'
+        output_filename = f'output_average_{n_files}_files_{selected_files_str}{extension}'
         
         # Save the result to the output directory
         output_path = os.path.join(output_dir, output_filename)
-        result_df.to_csv(output_path, index=False)
+        write_table(result_df, output_path)
         
         combo_count += 1
         print(f"  ✓ [{combo_count}] Files {selected_files_indices} → {output_filename}")
-        print(f"      Rows: {len(result_df)}, Columns: {len(result_df.columns)} (3 metadata + {len(result_df.columns)-3} features)")
+        n_metadata = len([col for col in result_df.columns if col in ('video', 'frame_number', 'frame_filename', 'propagated_from')])
+        print(f"      Rows: {len(result_df)}, Columns: {len(result_df.columns)} ({n_metadata} metadata + {len(result_df.columns)-n_metadata} features)")
 
 print(f"\n=== Averaging complete ===")
 print(f"All output files saved to: {output_dir}")
\ No newline at end of file